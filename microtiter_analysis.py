@@ -0,0 +1,502 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from microtiter_methods import MicrotiterMethods, ColorSet
+from microtiter_profiling import profiler
+from microtiter_raw import is_raw, open_raw
+from microtiter_grid import fit_homography, apply_homography
+from microtiter_aoi import AOI_SHAPE_SETTINGS, SUBPIXEL_BITS, SUBPIXEL_STEPS, get_AoI_shape
+from microtiter_flatfield import get_gain_map, apply_gain_map
+
+# Pure NumPy analysis core shared by the GUI and the headless command, nothing in here may import PyQt6.
+# Heavy imports (skimage) are deferred to the functions that need them to keep startup fast.
+
+def evaluate_plate(config, samples, control, methods=None):
+    # Scores every well of the samples image against the control AoI, returns an (n_rows, n_columns) array
+    if methods is None:
+        methods = MicrotiterMethods()
+    control_colors = aggregate_control(config, control, methods)
+    return score_plate(config, samples, control_colors, methods)
+
+def evaluate_plates(config, samples_list, control, methods=None):
+    # Plates sharing one grid and control, e.g. a time-lapse. Each plate is aggregated as soon as it is read, so
+    # samples_list may be a generator, then all (plates, n_rows, n_columns, 3) colors are scored in one pass.
+    if methods is None:
+        methods = MicrotiterMethods()
+    control_colors = aggregate_control(config, control, methods)
+    grid = np.array(generate_grid(config))
+    samples_rgb = np.stack([aggregate_wells(config, samples, methods, grid) for samples in samples_list])
+    samples_rgb = samples_rgb.reshape(-1, config["n_rows"], config["n_columns"], 3)
+    return score_colors(config, samples_rgb, control_colors, methods)
+
+def get_kinetics(cube, times=None, threshold=None):
+    # Per-well least squares slope of the score over time, and the time at which the score first crosses
+    # threshold from the side it started on, interpolated linearly between reads (nan if it never does)
+    cube = np.asarray(cube, dtype=float)
+    times = np.arange(len(cube), dtype=float) if times is None else np.asarray(times, dtype=float)
+    centered_times = times - times.mean()
+    denominator = centered_times @ centered_times
+    if denominator:
+        slope = np.tensordot(centered_times, cube - cube.mean(axis=0), axes=(0, 0))/denominator
+    else:
+        slope = np.zeros(cube.shape[1:])
+    kinetics = {"slope": slope}
+    if threshold is not None:
+        side = np.sign(cube - threshold)
+        crossed = (side != side[0]) | (side == 0)
+        first = crossed.argmax(axis=0)
+        after = np.maximum(first, 1)
+        before = after - 1
+        value_before = np.take_along_axis(cube, before[None], axis=0)[0]
+        value_after = np.take_along_axis(cube, np.minimum(after, len(cube)-1)[None], axis=0)[0]
+        step = value_after - value_before
+        fraction = np.divide(threshold - value_before, step, out=np.zeros_like(step), where=step != 0)
+        time_before = times[before]
+        time_after = times[np.minimum(after, len(times)-1)]
+        time_to_threshold = np.where(first == 0, times[0], time_before + fraction*(time_after - time_before))
+        kinetics["time_to_threshold"] = np.where(crossed.any(axis=0), time_to_threshold, np.nan)
+    return kinetics
+
+def aggregate_control(config, control, methods):
+    aggregation_method = methods.get_aggregation_method(config["aggregation_method"])
+    shape = get_AoI_shape(config)
+    with profiler.stage("extraction"):
+        control_stack = get_AoI_pixels(control, [config["control_x"]], [config["control_y"]], shape)
+    control_stack = correct_illumination(config, control_stack, [config["control_x"]], [config["control_y"]], control.shape)
+    with profiler.stage("aggregation"):
+        control_rgb = aggregation_method.calculate_batch(control_stack, shape)[0]
+    # Color space conversions of the control are kept with it and done once per evaluation
+    return ColorSet(control_rgb)
+
+def score_plate(config, samples, control_colors, methods):
+    grid = np.array(generate_grid(config))
+    scores = score_wells(config, samples, control_colors, methods, grid)
+    return scores.reshape(config["n_rows"], config["n_columns"])
+
+def score_wells(config, samples, control_colors, methods, grid):
+    # Scores the wells centered at the (x, y) rows of grid, returns one score per well
+    return score_colors(config, aggregate_wells(config, samples, methods, grid), control_colors, methods)
+
+def aggregate_wells(config, samples, methods, grid):
+    aggregation_method = methods.get_aggregation_method(config["aggregation_method"])
+    shape = get_AoI_shape(config)
+    with profiler.stage("extraction"):
+        if is_axis_aligned(config):
+            samples_stack = get_AoI_pixels(samples, grid[:, 0], grid[:, 1], shape)
+        else:
+            samples_stack = get_AoI_pixels_rotated(samples, grid[:, 0], grid[:, 1], shape, get_grid_axes(config))
+    samples_stack = correct_illumination(config, samples_stack, grid[:, 0], grid[:, 1], samples.shape)
+    with profiler.stage("aggregation"):
+        return aggregation_method.calculate_batch(samples_stack, shape)
+
+def correct_illumination(config, stack, xs, ys, image_shape):
+    # Flat-field correction of the AoI pixels around (xs, ys), when the config has a gain map. The map only fits
+    # images of the size of its blank, the samples and the control alike.
+    gain_map = get_gain_map(config)
+    if gain_map is None:
+        return stack
+    with profiler.stage("flat_field"):
+        return apply_gain_map(stack, gain_map, xs, ys, image_shape)
+
+def score_colors(config, samples_rgb, control_colors, methods):
+    # Scoring stage only, samples_rgb may have any leading shape as long as the last axis is RGB
+    scoring_method = methods.get_scoring_method(config["scoring_method"])
+    samples_rgb = np.asarray(samples_rgb)
+    samples = ColorSet(samples_rgb.reshape(-1, 3)).prepare(scoring_method.color_spaces)
+    control_colors.prepare(scoring_method.color_spaces)
+    with profiler.stage("scoring"):
+        scores = scoring_method.calculate_batch(samples, control_colors)
+    return scores.reshape(samples_rgb.shape[:-1])
+
+# Optional references every well is also scored against, each a well of the samples image ({"name": "Blank",
+# "well": "A1"}) or a point of the control image ({"name": "Positive", "x": 300, "y": 300}). References with
+# a "value", e.g. a concentration, form a standard curve.
+
+def parse_well(name, n_rows, n_columns):
+    # Flat index of a well name like "B12"
+    row = ord(name[:1].upper() or "?") - ord('A')
+    column = int(name[1:]) - 1 if name[1:].isdigit() else -1
+    if not (0 <= row < n_rows and 0 <= column < n_columns):
+        raise ValueError("Well " + repr(name) + " is not on the plate")
+    return row*n_columns + column
+
+def aggregate_control_references(config, control, methods):
+    # (references, 3) colors of the references on the control image, nan for the wells of the samples image.
+    # Decoding the control image is left to the caller, it is not needed when no reference is on it.
+    references = config.get("references", [])
+    colors = np.full((len(references), 3), np.nan)
+    on_control = [idx for idx, reference in enumerate(references) if "well" not in reference]
+    if on_control:
+        aggregation_method = methods.get_aggregation_method(config["aggregation_method"])
+        shape = get_AoI_shape(config)
+        xs = [references[idx]["x"] for idx in on_control]
+        ys = [references[idx]["y"] for idx in on_control]
+        with profiler.stage("extraction"):
+            control_stack = get_AoI_pixels(control, xs, ys, shape)
+        control_stack = correct_illumination(config, control_stack, xs, ys, control.shape)
+        with profiler.stage("aggregation"):
+            colors[on_control] = aggregation_method.calculate_batch(control_stack, shape)
+    return colors
+
+def has_control_references(config):
+    return any("well" not in reference for reference in config.get("references", []))
+
+def get_reference_colors(config, samples_rgb, control_references):
+    # Colors of all references in config order, the wells are picked from the aggregated samples
+    colors = np.array(control_references, dtype=float)
+    samples_rgb = np.asarray(samples_rgb).reshape(-1, 3)
+    for idx, reference in enumerate(config["references"]):
+        if "well" in reference:
+            colors[idx] = samples_rgb[parse_well(reference["well"], config["n_rows"], config["n_columns"])]
+    return ColorSet(colors)
+
+def score_references(config, samples_rgb, reference_colors, methods):
+    # (wells..., references) distances of every well to every reference in one pass: the samples are a
+    # (wells, 1, 3) column that the batch kernels broadcast against the (references, 3) colors
+    scoring_method = methods.get_scoring_method(config["scoring_method"])
+    samples_rgb = np.asarray(samples_rgb)
+    n_references = len(reference_colors["rgb"])
+    reference_colors.prepare(scoring_method.color_spaces)
+    with profiler.stage("scoring"):
+        if scoring_method.kernel == "batch":
+            samples = ColorSet(samples_rgb.reshape(-1, 1, 3)).prepare(scoring_method.color_spaces)
+            distances = scoring_method.calculate_batch(samples, reference_colors)
+        else:
+            # Kernels registered per well compare to a single control, one column per reference
+            samples = ColorSet(samples_rgb.reshape(-1, 3)).prepare(scoring_method.color_spaces)
+            distances = np.stack([scoring_method.calculate_batch(samples, ColorSet(color)) for color in reference_colors["rgb"]], axis=-1)
+    return distances.reshape(samples_rgb.shape[:-1] + (n_references,))
+
+def get_standard_curve_values(config, distances):
+    # Value of every well on the standard curve through the references with a value, ordered by it. Interpolated
+    # between the nearest standard and the closer of its neighbours on the curve, in proportion to the distances
+    # to both, so it works with every scoring method. None without at least two standards.
+    references = config.get("references", [])
+    standards = [idx for idx, reference in enumerate(references) if reference.get("value") is not None]
+    if len(standards) < 2:
+        return None
+    values = np.array([references[idx]["value"] for idx in standards], dtype=float)
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    curve = distances[..., np.array(standards)[order]]
+    last = len(values) - 1
+    nearest = curve.argmin(axis=-1)
+    below = np.maximum(nearest - 1, 0)
+    above = np.minimum(nearest + 1, last)
+    distance_nearest = np.take_along_axis(curve, nearest[..., None], axis=-1)[..., 0]
+    distance_below = np.take_along_axis(curve, below[..., None], axis=-1)[..., 0]
+    distance_above = np.take_along_axis(curve, above[..., None], axis=-1)[..., 0]
+    # At the ends of the curve the only neighbour is taken
+    use_above = (nearest == 0) | ((nearest < last) & (distance_above < distance_below))
+    neighbour = np.where(use_above, above, below)
+    total = distance_nearest + np.where(use_above, distance_above, distance_below)
+    fraction = np.divide(distance_nearest, total, out=np.zeros_like(total), where=total > 0)
+    return values[nearest] + (values[neighbour] - values[nearest])*fraction
+
+def evaluate_references(config, samples_rgb, control_references, methods):
+    # Distance matrix of all wells to all references, the nearest reference of every well and its value on the
+    # standard curve (None without one), all (n_rows, n_columns) leading
+    samples_rgb = np.asarray(samples_rgb).reshape(config["n_rows"], config["n_columns"], 3)
+    reference_colors = get_reference_colors(config, samples_rgb, control_references)
+    distances = score_references(config, samples_rgb, reference_colors, methods)
+    return {
+        "distances": distances,
+        "nearest": distances.argmin(axis=-1),
+        "values": get_standard_curve_values(config, distances),
+    }
+
+# Optional corners of a rotated or skewed grid, without them the grid is axis-aligned
+GRID_CORNERS = ("top_right_x", "top_right_y", "bottom_left_x", "bottom_left_y")
+
+# Settings the aggregated well colors depend on, everything else only affects scoring
+AGGREGATION_SETTINGS = ("top_left_x", "top_left_y", "bottom_right_x", "bottom_right_y") + GRID_CORNERS + ("n_rows", "n_columns", "AoI_size") + AOI_SHAPE_SETTINGS + ("flat_field", "aggregation_method")
+
+class AggregationCache:
+    # Memoizes aggregated (n_rows, n_columns, 3) well colors, so scoring or control changes skip the AoI stage
+    def __init__(self, limit=8):
+        self.entries = OrderedDict()
+        self.limit = limit
+
+    def get_key(self, image_key, config):
+        if image_key is None:
+            return None
+        key = (image_key,) + tuple(config.get(setting) for setting in AGGREGATION_SETTINGS)
+        # A mask or gain map edited in place keeps its path, so its size and mtime are part of the key too
+        paths = [config.get("flat_field")]
+        if config.get("AoI_shape") == "mask":
+            paths.append(config.get("AoI_mask"))
+        for path in paths:
+            if not path:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Reported by the aggregation itself, which then is not cached
+                return None
+            key += (stat.st_size, stat.st_mtime_ns)
+        return key
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, samples_rgb):
+        if key is None:
+            return
+        self.entries[key] = samples_rgb
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+def generate_grid(config):
+    homography = get_grid_homography(config)
+    if homography is not None:
+        # Rotated or skewed grid, well centers are fractional and sampled with get_AoI_pixels_rotated
+        indices = np.stack(np.meshgrid(np.arange(config["n_columns"]), np.arange(config["n_rows"])), axis=-1).reshape(-1, 2)
+        return [tuple(point) for point in apply_homography(homography, indices).tolist()]
+    grid = []
+    spacing_x = (config["bottom_right_x"]-config["top_left_x"])/(config["n_columns"] - 1)
+    spacing_y = (config["bottom_right_y"]-config["top_left_y"])/(config["n_rows"] - 1)
+    for i in range(config["n_rows"]):
+        for j in range(config["n_columns"]):
+            grid.append((round(config["top_left_x"]+j*spacing_x), round(config["top_left_y"]+i*spacing_y)))
+    return grid
+
+def get_grid_corners(config):
+    # Centers of the top left, top right, bottom left and bottom right wells
+    top_right = (config.get("top_right_x", config["bottom_right_x"]), config.get("top_right_y", config["top_left_y"]))
+    bottom_left = (config.get("bottom_left_x", config["top_left_x"]), config.get("bottom_left_y", config["bottom_right_y"]))
+    return [(config["top_left_x"], config["top_left_y"]), top_right, bottom_left, (config["bottom_right_x"], config["bottom_right_y"])]
+
+def is_axis_aligned(config):
+    top_left, top_right, bottom_left, bottom_right = get_grid_corners(config)
+    return top_right == (bottom_right[0], top_left[1]) and bottom_left == (top_left[0], bottom_right[1])
+
+def get_grid_homography(config):
+    # Maps (column, row) well indices onto the image through the four corner wells, None for an axis-aligned grid
+    if is_axis_aligned(config):
+        return None
+    last_column = config["n_columns"] - 1
+    last_row = config["n_rows"] - 1
+    indices = np.array([[0, 0], [last_column, 0], [0, last_row], [last_column, last_row]], dtype=float)
+    return fit_homography(indices, np.array(get_grid_corners(config), dtype=float))
+
+def get_grid_axes(config):
+    # Unit steps along a row and down a column of the grid, averaged over its opposite edges. A plate is close
+    # enough to flat that every well can share them.
+    top_left, top_right, bottom_left, bottom_right = np.array(get_grid_corners(config), dtype=float)
+    along = top_right - top_left + bottom_right - bottom_left
+    down = bottom_left - top_left + bottom_right - top_right
+    return tuple((along/np.hypot(*along)).tolist()), tuple((down/np.hypot(*down)).tolist())
+
+def get_grid_spacing(config):
+    # Distance between neighbouring wells along the top row and the left column
+    top_left, top_right, bottom_left, _ = get_grid_corners(config)
+    spacing_x = np.hypot(top_right[0] - top_left[0], top_right[1] - top_left[1])/(config["n_columns"] - 1)
+    spacing_y = np.hypot(bottom_left[0] - top_left[0], bottom_left[1] - top_left[1])/(config["n_rows"] - 1)
+    return spacing_x, spacing_y
+
+def load_image(path):
+    # Decodes an image file into an (H, W, 3) uint8 array, the same layout as ImageBuffer.array.
+    # Raw frames are memory-mapped instead, only the pages that get indexed are read.
+    if is_raw(path):
+        return open_raw(path)
+    from skimage.io import imread
+    with profiler.stage("decode"):
+        image = imread(path)
+    if image.dtype != np.uint8:
+        image = (image / np.iinfo(image.dtype).max * 255).round().astype(np.uint8)
+    if image.ndim == 2:
+        image = np.stack([image]*3, axis=-1)
+    return np.ascontiguousarray(image[:, :, :3])
+
+def get_AoI(array, x, y, size):
+    height, width = array.shape[:2]
+    half = size//2
+    top = y-half
+    left = x-half
+    if top >= 0 and left >= 0 and top+size <= height and left+size <= width:
+        return array[top:top+size, left:left+size]
+    # Pixels outside of the image read as black, same as QImage.pixelColor
+    aoi = np.zeros((size, size, 3), dtype=np.uint8)
+    y0, y1 = max(top, 0), min(top+size, height)
+    x0, x1 = max(left, 0), min(left+size, width)
+    if y0 < y1 and x0 < x1:
+        aoi[y0-top:y1-top, x0-left:x1-left] = array[y0:y1, x0:x1]
+    return aoi
+
+def get_AoI_pixels(array, xs, ys, shape):
+    # Gathers the pixels of shape around all given centers at once into a (len(xs), len(shape), 3) stack
+    height, width = array.shape[:2]
+    xs = np.asarray(xs)
+    ys = np.asarray(ys)
+    if not array.size or not len(xs):
+        return np.zeros((len(xs), len(shape), 3), dtype=np.uint8)
+    if array.flags.c_contiguous and shape.is_inside(xs, ys, width, height):
+        # Every AoI is in the image, so each pixel is its center plus the precomputed offset
+        pixels = array.reshape((height*width,) + array.shape[2:])
+        return np.take(pixels, (ys*width + xs)[:, None] + shape.get_offsets(width), axis=0)
+    return get_AoI_pixels_clipped(array, ys[:, None] + shape.rows, xs[:, None] + shape.columns)
+
+def get_AoI_pixels_rotated(array, xs, ys, shape, axes):
+    # Same as get_AoI_pixels for the fractional centers of a rotated grid. The AoI turns with the grid onto the
+    # given axes and each of its pixels is the one nearest to where it lands, so every AoI is a single gather too.
+    height, width = array.shape[:2]
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if not array.size or not len(xs):
+        return np.zeros((len(xs), len(shape), 3), dtype=np.uint8)
+    key = (shape.key, axes, width, height)
+    indices = ROTATED_AOI_CACHE.get(key, xs, ys)
+    if indices is None:
+        # Centers in 1/SUBPIXEL_STEPS pixel steps, split into the whole pixel and the step within it
+        steps = np.stack((ys, xs))
+        steps *= SUBPIXEL_STEPS
+        steps = np.rint(steps, out=steps).astype(np.intp)
+        tops, lefts = whole = steps >> SUBPIXEL_BITS
+        steps &= SUBPIXEL_STEPS - 1
+        positions = steps[0] << SUBPIXEL_BITS
+        positions |= steps[1]
+        rows, columns, offsets, reach = shape.get_rotated_offsets(width, axes)
+        low = whole.min(axis=1) - reach
+        high = whole.max(axis=1) + reach
+        if not (array.flags.c_contiguous and low.min() >= 0 and high[0] < height and high[1] < width):
+            return get_AoI_pixels_clipped(array, tops[:, None] + np.take(rows, positions, axis=0), lefts[:, None] + np.take(columns, positions, axis=0))
+        indices = np.take(offsets, positions, axis=0)
+        indices += (tops*width + lefts)[:, None]
+        ROTATED_AOI_CACHE.put(key, xs, ys, indices)
+    return np.take(array.reshape((height*width,) + array.shape[2:]), indices, axis=0)
+
+class RotatedAoICache:
+    # Pixel indices of the AoIs of the latest rotated grids, most recent first. Every image of a series or a
+    # watched folder is sampled at the same wells, which then leaves a single gather per image.
+    def __init__(self, limit=2):
+        self.entries = []
+        self.limit = limit
+        # Evaluation workers and the GUI thread extract concurrently
+        self.lock = threading.Lock()
+
+    def get(self, key, xs, ys):
+        with self.lock:
+            for index, (entry_key, entry_xs, entry_ys, indices) in enumerate(self.entries):
+                if entry_key == key and np.array_equal(entry_xs, xs) and np.array_equal(entry_ys, ys):
+                    self.entries.insert(0, self.entries.pop(index))
+                    return indices
+        return None
+
+    def put(self, key, xs, ys, indices):
+        with self.lock:
+            self.entries.insert(0, (key, xs.copy(), ys.copy(), indices))
+            del self.entries[self.limit:]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+ROTATED_AOI_CACHE = RotatedAoICache()
+
+def get_AoI_pixels_clipped(array, rows, cols):
+    # Pixels at the given rows and columns, black where they fall outside the image
+    height, width = array.shape[:2]
+    valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    rows = np.clip(rows, 0, height-1)
+    cols = np.clip(cols, 0, width-1)
+    if array.flags.c_contiguous:
+        stack = np.take(array.reshape((height*width,) + array.shape[2:]), rows*width + cols, axis=0)
+    else:
+        stack = array[rows, cols]
+    if not valid.all():
+        stack[~valid] = 0
+    return stack
+
+def idx_to_letter(idx):
+    return chr(ord('A')+idx)
+
+def get_results_string(config, array, aggregation_label, scoring_label, profiling_lines=None):
+    nparray = np.array(array)
+    res = ""
+    # Embed settings as comments
+    res += "# Settings:\n"
+    res += "# path_samples = "+config["path_samples"]+"\n"
+    res += "# path_control = "+config["path_control"]+"\n"
+    res += "# top_left_x = "+str(config["top_left_x"])+"\n"
+    res += "# top_left_y = "+str(config["top_left_y"])+"\n"
+    res += "# bottom_right_x = "+str(config["bottom_right_x"])+"\n"
+    res += "# bottom_right_y = "+str(config["bottom_right_y"])+"\n"
+    for setting in GRID_CORNERS:
+        if setting in config:
+            res += "# "+setting+" = "+str(config[setting])+"\n"
+    res += "# n_rows = "+str(config["n_rows"])+"\n"
+    res += "# n_columns = "+str(config["n_columns"])+"\n"
+    res += "# control_x = "+str(config["control_x"])+"\n"
+    res += "# control_y = "+str(config["control_y"])+"\n"
+    res += "# AoI_size = "+str(config["AoI_size"])+"\n"
+    for setting in AOI_SHAPE_SETTINGS + ("flat_field",):
+        if setting in config:
+            res += "# "+setting+" = "+str(config[setting])+"\n"
+    res += "# aggregation_method = "+aggregation_label+"\n"
+    res += "# scoring_method = "+scoring_label+"\n"
+    if profiling_lines:
+        res += "# Profiling:\n"
+        for line in profiling_lines:
+            res += "# "+line+"\n"
+    # Simple min max positions
+    res += "# Results:\n"
+    idx_min = np.unravel_index(nparray.argmin(), nparray.shape)
+    res += "# Closest match: " + idx_to_letter(idx_min[0]) + str(idx_min[1]+1) + "\n"
+    idx_max = np.unravel_index(nparray.argmax(), nparray.shape)
+    res += "# Farthest match: " + idx_to_letter(idx_max[0]) + str(idx_max[1]+1) + "\n"
+    res += get_table_string(array)
+    return res
+
+def get_table_string(array):
+    # Rounded once for the whole table, the lines are joined instead of growing one string value by value
+    rounded = np.round(np.asarray(array, dtype=float), 2).tolist()
+    lines = ["".join(str(number) + "\t" for number in range(len(rounded[0])+1))]
+    for idx, row in enumerate(rounded):
+        lines.append(idx_to_letter(idx) + "\t" + "".join(str(value) + "\t" for value in row))
+    return "\n".join(lines) + "\n"
+
+def get_kinetics_string(kinetics, interval, threshold):
+    res = "# Kinetics:\n"
+    res += "# interval = "+str(interval)+"\n"
+    res += "# threshold = "+str(threshold)+"\n"
+    res += "# Slope per time unit:\n"
+    res += get_table_string(kinetics["slope"])
+    res += "# Time to threshold (nan if never reached):\n"
+    res += get_table_string(kinetics["time_to_threshold"])
+    return res
+
+def get_reference_label(reference):
+    if "well" in reference:
+        label = reference["name"] + " (well " + reference["well"]
+    else:
+        label = reference["name"] + " (control " + str(reference["x"]) + ", " + str(reference["y"])
+    if reference.get("value") is not None:
+        label += ", value " + str(reference["value"])
+    return label + ")"
+
+def get_references_string(config, reference_results):
+    references = config["references"]
+    res = "# References:\n"
+    for idx, reference in enumerate(references):
+        res += "# " + str(idx+1) + " = " + get_reference_label(reference) + "\n"
+    res += "# Nearest reference:\n"
+    nearest = (reference_results["nearest"] + 1).tolist()
+    lines = ["".join(str(number) + "\t" for number in range(len(nearest[0])+1))]
+    for idx, row in enumerate(nearest):
+        lines.append(idx_to_letter(idx) + "\t" + "".join(str(value) + "\t" for value in row))
+    res += "\n".join(lines) + "\n"
+    for idx, reference in enumerate(references):
+        res += "# Distance to " + reference["name"] + ":\n"
+        res += get_table_string(reference_results["distances"][..., idx])
+    if reference_results["values"] is not None:
+        res += "# Standard curve value:\n"
+        res += get_table_string(reference_results["values"])
+    return res
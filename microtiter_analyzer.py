@@ -0,0 +1,218 @@
+import os
+import sys
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from microtiter_methods import MicrotiterMethods, ColorSet
+from microtiter_analysis import aggregate_control, aggregate_wells, score_colors, score_plate, generate_grid, load_image, get_results_string, idx_to_letter
+from microtiter_analysis import aggregate_control_references, has_control_references, evaluate_references, get_references_string
+from microtiter_grid import get_detected_config
+from microtiter_export import get_results_writer_class, export_results
+from microtiter_store import CORNER_SETTINGS, ResultStore
+
+# Headless batch evaluation, usage: python -m microtiter_analyzer config.json samples/ -j 8
+
+IMAGE_EXTENSIONS = (".jpeg", ".jpg", ".png", ".bmp", ".tif", ".tiff")
+
+class PlateEvaluator:
+    # Holds everything that is shared by all images of a run, so the control is only decoded once.
+    # With a ResultStore every stage is looked up on disk first and images are only decoded when one is missing.
+    def __init__(self, config, control_colors=None, detect_grid=False, store=None):
+        self.config = config
+        self.detect_grid = detect_grid
+        self.store = store
+        self.methods = MicrotiterMethods()
+        self.aggregation_method = self.methods.get_aggregation_method(config["aggregation_method"])
+        self.scoring_method = self.methods.get_scoring_method(config["scoring_method"])
+        if control_colors is None:
+            control_colors = self.get_control_colors()
+        self.control_colors = control_colors
+        # Colors of the references on the control image, the wells of the samples image are taken per plate
+        self.control_references = None
+        if config.get("references"):
+            control = load_image(config["path_control"]) if has_control_references(config) else None
+            self.control_references = aggregate_control_references(config, control, self.methods)
+
+    def get_control_colors(self):
+        if self.store is None:
+            return aggregate_control(self.config, load_image(self.config["path_control"]), self.methods)
+        key = self.store.get_key("control", self.config)
+        control_rgb = self.store.get(key)
+        if control_rgb is not None:
+            return ColorSet(control_rgb)
+        control_colors = aggregate_control(self.config, load_image(self.config["path_control"]), self.methods)
+        self.store.put(key, control_colors["rgb"])
+        return control_colors
+
+    def evaluate(self, samples, config=None):
+        return score_plate(config or self.config, samples, self.control_colors, self.methods)
+
+    def process(self, path, output_dir):
+        # Evaluates one image and writes its results file, errors are returned instead of raised.
+        # The config the image was evaluated with comes last.
+        config = dict(self.config, path_samples=path)
+        try:
+            if self.store is not None:
+                results, config, samples_rgb = self.evaluate_stored(path, config)
+            else:
+                samples = load_image(path)
+                if self.detect_grid:
+                    # Each image gets its own grid, the control AoI stays where the config puts it
+                    config = get_detected_config(config, samples)
+                samples_rgb = aggregate_wells(config, samples, self.methods, np.array(generate_grid(config)))
+                results = score_colors(config, samples_rgb, self.control_colors, self.methods).reshape(config["n_rows"], config["n_columns"])
+            res_string = get_results_string(config, results, self.aggregation_method.label, self.scoring_method.label)
+            if self.control_references is not None:
+                res_string += get_references_string(config, evaluate_references(config, samples_rgb, self.control_references, self.methods))
+            # A full disk or missing output folder fails this plate, not the run or watch it is part of
+            with open(get_output_path(path, output_dir), "w") as file:
+                file.write(res_string)
+        except Exception as error:
+            return path, None, str(error), config
+        return path, results, None, config
+
+    def evaluate_stored(self, path, config):
+        # Same results as without the store, but a stage whose inputs did not change since it was stored is read back,
+        # e.g. a new scoring method only rescores the stored well colors
+        store = self.store
+        samples = None
+        if self.detect_grid:
+            grid_key = store.get_key("grid", config)
+            corners = store.get(grid_key)
+            if corners is None:
+                samples = load_image(path)
+                config = get_detected_config(config, samples)
+                store.put(grid_key, [config[setting] for setting in CORNER_SETTINGS])
+            else:
+                config = dict(config, **dict(zip(CORNER_SETTINGS, corners.tolist())))
+        scores_key = store.get_key("scores", config)
+        results = store.get(scores_key)
+        # The references are scored from the well colors, they are not stored on their own
+        if results is not None and self.control_references is None:
+            return results, config, None
+        wells_key = store.get_key("wells", config)
+        samples_rgb = store.get(wells_key)
+        if samples_rgb is None:
+            if samples is None:
+                samples = load_image(path)
+            samples_rgb = aggregate_wells(config, samples, self.methods, np.array(generate_grid(config)))
+            store.put(wells_key, samples_rgb)
+        if results is None:
+            results = score_colors(config, samples_rgb, self.control_colors, self.methods).reshape(config["n_rows"], config["n_columns"])
+            store.put(scores_key, results)
+        return results, config, samples_rgb
+
+def get_store(args):
+    # The ResultStore asked for by --store and --store-size, None without --store
+    if args.store is None:
+        return None
+    return ResultStore(args.store or None, int(args.store_size*1024*1024))
+
+def add_store_arguments(parser):
+    parser.add_argument("--store", nargs="?", const="", help="keep the results of every stage in a store on disk and reuse them for images and settings evaluated before, in DIR or ~/.cache/microtiter_analyzer")
+    parser.add_argument("--store-size", type=float, default=512, help="megabytes the store may use before the least recently used results are removed (default: 512)")
+
+worker_evaluator = None
+
+def init_worker(config, control_colors, detect_grid, store=None):
+    global worker_evaluator
+    worker_evaluator = PlateEvaluator(config, control_colors, detect_grid, store)
+
+def process_in_worker(path, output_dir):
+    return worker_evaluator.process(path, output_dir)
+
+def get_output_path(path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".csv")
+
+def find_images(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = sorted(os.listdir(pattern))
+            paths += [os.path.join(pattern, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+        elif glob.has_magic(pattern):
+            paths += sorted(glob.glob(pattern))
+        else:
+            paths.append(pattern)
+    return paths
+
+def get_summary_string(config, results):
+    # One line per image with the score of every well, in the same precision as the results files
+    res = get_summary_header(config)
+    for path, array in results:
+        res += get_summary_line(path, array)
+    return res
+
+def get_summary_header(config):
+    header = ["image"]
+    for i in range(config["n_rows"]):
+        for j in range(config["n_columns"]):
+            header.append(idx_to_letter(i) + str(j+1))
+    return "\t".join(header) + "\n"
+
+def get_summary_line(path, array):
+    return path + "\t" + "\t".join(str(round(value, 2)) for value in array.ravel()) + "\n"
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="microtiter_analyzer", description="Evaluate microtiter plate images without the GUI.")
+    parser.add_argument("config", help="config.json saved from the GUI")
+    parser.add_argument("samples", nargs="+", help="sample images, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default="results", help="directory for the results files (default: results)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--summary", default="summary.csv", help="name of the combined summary file (default: summary.csv)")
+    parser.add_argument("--detect-grid", action="store_true", help="detect the well grid in every image instead of using the corners from the config")
+    parser.add_argument("--export", help="also write the full precision results of all images with their settings into one .csv, .npz or .parquet file")
+    parser.add_argument("--append", action="store_true", help="add the images to the --export file instead of replacing it")
+    add_store_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.config, "r") as file:
+        config = json.load(file)
+    paths = find_images(args.samples)
+    if not paths:
+        print("No sample images found.", file=sys.stderr)
+        return 1
+    if args.export:
+        try:
+            get_results_writer_class(args.export)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+    store = get_store(args)
+    try:
+        evaluator = PlateEvaluator(config, detect_grid=args.detect_grid, store=store)
+    except (OSError, ValueError) as error:
+        # Without the control (or the mask or gain map it is aggregated with) no plate can be scored
+        print(error, file=sys.stderr)
+        return 1
+    output_dirs = [args.output_dir]*len(paths)
+    if args.workers > 1:
+        chunksize = max(1, len(paths)//(args.workers*4))
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(config, evaluator.control_colors, args.detect_grid, store)) as executor:
+            processed = list(executor.map(process_in_worker, paths, output_dirs, chunksize=chunksize))
+    else:
+        processed = list(map(evaluator.process, paths, output_dirs))
+    results = []
+    configs = []
+    failed = 0
+    for path, array, error, config_used in processed:
+        if error is None:
+            results.append((path, array))
+            configs.append(config_used)
+        else:
+            failed += 1
+            print(f"{path}: {error}", file=sys.stderr)
+    with open(os.path.join(args.output_dir, args.summary), "w") as file:
+        file.write(get_summary_string(config, results))
+    if args.export and results:
+        export_results(args.export, configs, [array for _, array in results], args.append)
+    print(f"Evaluated {len(results)} of {len(paths)} images into {args.output_dir}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Shapes of the Area of Interest around a well. A shape is compiled once into the (row, column) offsets of its
+# pixels from the well center, so extraction gathers exactly those pixels of every well in one indexing call.
+# Nothing in here may import PyQt6.
+
+AOI_SHAPES = {"square": "Square", "disc": "Disc", "annulus": "Annulus", "mask": "Mask image"}
+
+# Optional settings of the shape, without them the AoI is an AoI_size x AoI_size square
+AOI_SHAPE_SETTINGS = ("AoI_shape", "AoI_inner_size", "AoI_mask")
+
+# Wells of a rotated grid have fractional centers, placed to 1/SUBPIXEL_STEPS of a pixel
+SUBPIXEL_BITS = 3
+SUBPIXEL_STEPS = 1 << SUBPIXEL_BITS
+
+class AoIShape:
+    # Pixels of the AoI in row-major order, as offsets from the center of a size x size window
+    def __init__(self, key, mask):
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            raise ValueError("The AoI shape has no pixels")
+        # Settings the shape was compiled from, the shape code comes first
+        self.key = key
+        self.code = key[0]
+        self.size = max(mask.shape)
+        rows, columns = np.nonzero(mask)
+        self.rows = rows - mask.shape[0]//2
+        self.columns = columns - mask.shape[1]//2
+        # Smallest odd window around the center holding every pixel, and where the pixels are in it
+        self.radius = int(max(np.abs(self.rows).max(), np.abs(self.columns).max()))
+        self.window = 2*self.radius + 1
+        self.positions = (self.rows + self.radius)*self.window + self.columns + self.radius
+        self.full = len(self.positions) == self.window**2
+        self.offsets = {}
+        self.rotated = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_offsets(self, width):
+        # Offsets of the pixels in a flattened image of the given width
+        if width not in self.offsets:
+            self.offsets[width] = self.rows*width + self.columns
+        return self.offsets[width]
+
+    def get_rotated_offsets(self, width, axes):
+        # The shape turned onto the (along a row, down a column) unit axes of a rotated grid, with every pixel
+        # moved to the nearest one. There is one line per sub-pixel position of the center (SUBPIXEL_STEPS per
+        # pixel, row-major), holding the rows, columns and offsets in a flattened image of the given width.
+        key = (width, axes)
+        if key not in self.rotated:
+            (along_x, along_y), (down_x, down_y) = axes
+            steps = np.arange(SUBPIXEL_STEPS)/SUBPIXEL_STEPS
+            fractions_y, fractions_x = [fractions.reshape(-1, 1) for fractions in np.meshgrid(steps, steps, indexing="ij")]
+            rows = np.floor(fractions_y + self.columns*along_y + self.rows*down_y + 0.5).astype(np.intp)
+            columns = np.floor(fractions_x + self.columns*along_x + self.rows*down_x + 0.5).astype(np.intp)
+            reach = int(max(np.abs(rows).max(), np.abs(columns).max()))
+            # Every recalibration turns the axes a little, so only the latest ones are kept
+            if len(self.rotated) >= 8:
+                self.rotated.clear()
+            self.rotated[key] = (rows, columns, rows*width + columns, reach)
+        return self.rotated[key]
+
+    def is_inside(self, xs, ys, width, height):
+        # Whether every AoI around the (xs, ys) centers lies fully inside the image
+        return (xs.min() - self.radius >= 0 and ys.min() - self.radius >= 0
+            and xs.max() + self.radius < width and ys.max() + self.radius < height)
+
+def get_square_mask(size):
+    return np.ones((size, size), dtype=bool)
+
+def get_disc_mask(size, inner_size=0):
+    # Pixels whose center is within size/2 of the AoI center, and not closer than inner_size/2
+    offsets = np.arange(size) - size//2
+    distances = offsets[:, None]**2 + offsets[None, :]**2
+    return (distances <= (size/2)**2) & (distances >= (inner_size/2)**2)
+
+def load_mask(path):
+    # Every pixel of the mask image that is not black belongs to the AoI, the image is centered on the well
+    from skimage.io import imread
+    image = imread(path)
+    if image.ndim == 3:
+        image = image[:, :, :3].max(axis=-1)
+    return image > 0
+
+class AoIShapeCache:
+    # Compiled shapes keyed by their settings, least recently used first. A mask image is reloaded once it changes.
+    def __init__(self, limit=8):
+        self.entries = OrderedDict()
+        self.limit = limit
+        # Evaluation workers and the GUI thread compile shapes concurrently
+        self.lock = threading.Lock()
+
+    def get_key(self, config):
+        code = config.get("AoI_shape", "square")
+        if code == "mask":
+            path = config.get("AoI_mask")
+            if not path:
+                raise ValueError("The mask AoI shape needs an AoI_mask image")
+            return (code, path, os.path.getmtime(path))
+        if code == "annulus":
+            return (code, config["AoI_size"], config.get("AoI_inner_size", 0))
+        return (code, config["AoI_size"])
+
+    def get(self, config):
+        key = self.get_key(config)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            shape = self.compile(key)
+            self.entries[key] = shape
+            if len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+            return shape
+
+    def compile(self, key):
+        code = key[0]
+        if code == "square":
+            return AoIShape(key, get_square_mask(key[1]))
+        if code == "disc":
+            return AoIShape(key, get_disc_mask(key[1]))
+        if code == "annulus":
+            return AoIShape(key, get_disc_mask(key[1], key[2]))
+        if code == "mask":
+            return AoIShape(key, load_mask(key[1]))
+        raise ValueError("Unknown AoI shape: "+str(code))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+AOI_SHAPE_CACHE = AoIShapeCache()
+
+def get_AoI_shape(config):
+    return AOI_SHAPE_CACHE.get(config)
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import numpy as np
+from microtiter_methods import MicrotiterMethods, ColorSet
+from microtiter_aoi import get_AoI_shape
+from microtiter_analysis import generate_grid, get_grid_corners, get_grid_axes, load_image, get_AoI_pixels, get_AoI_pixels_rotated, ROTATED_AOI_CACHE
+from microtiter_flatfield import build_gain_map, apply_gain_map
+
+# Benchmark of the evaluation pipeline on synthetic plates, usage: python -m microtiter_benchmark -o bench.json
+
+PLATE_FORMATS = {6: (2, 3), 24: (4, 6), 96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+AOI_SIZES = [1, 5, 11, 21, 41]
+IMAGE_WIDTH = 2400
+IMAGE_HEIGHT = 1600
+
+def make_plate(n_rows, n_columns, seed=0):
+    # Evenly spaced wells of random colors on a light background, with some sensor noise
+    rng = np.random.default_rng(seed)
+    image = np.full((IMAGE_HEIGHT, IMAGE_WIDTH, 3), 230, dtype=np.uint8)
+    margin = 60
+    config = {
+        "path_samples": "",
+        "path_control": "",
+        "n_rows": n_rows,
+        "n_columns": n_columns,
+        "top_left_x": margin,
+        "top_left_y": margin,
+        "bottom_right_x": IMAGE_WIDTH - margin,
+        "bottom_right_y": IMAGE_HEIGHT - margin,
+        "control_x": margin,
+        "control_y": margin,
+        "AoI_size": 1,
+        "aggregation_method": "arithmetic_mean",
+        "scoring_method": "euclidian_rgb",
+    }
+    half = max(1, round(min((IMAGE_WIDTH - 2*margin)/(n_columns - 1), (IMAGE_HEIGHT - 2*margin)/(n_rows - 1), 2*margin)*0.4))
+    for x, y in generate_grid(config):
+        image[y-half:y+half+1, x-half:x+half+1] = rng.integers(0, 256, 3)
+    noise = rng.integers(-8, 9, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8), config
+
+def rotate_config(config, degrees):
+    # The same grid turned around the image center, as four corner wells
+    angle = np.radians(degrees)
+    center_x, center_y = IMAGE_WIDTH/2, IMAGE_HEIGHT/2
+    rotated = dict(config)
+    for name, (x, y) in zip(["top_left", "top_right", "bottom_left", "bottom_right"], get_grid_corners(config)):
+        rotated[name+"_x"] = round(center_x + (x-center_x)*np.cos(angle) - (y-center_y)*np.sin(angle))
+        rotated[name+"_y"] = round(center_y + (x-center_x)*np.sin(angle) + (y-center_y)*np.cos(angle))
+    return rotated
+
+def measure(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, {"min": min(timings), "median": statistics.median(timings), "repeats": repeats}
+
+def measure_alternately(functions, repeats):
+    # Times the functions in turns, so a slow stretch of the machine hits all of them alike and their ratio holds
+    timings = [[] for _ in functions]
+    for _ in range(repeats):
+        for function, function_timings in zip(functions, timings):
+            start = time.perf_counter()
+            function()
+            function_timings.append(time.perf_counter() - start)
+    return [{"min": min(t), "median": statistics.median(t), "repeats": repeats} for t in timings]
+
+def run(wells_list, AoI_sizes, repeats):
+    from skimage.io import imsave
+    methods = MicrotiterMethods()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for wells in wells_list:
+            n_rows, n_columns = PLATE_FORMATS[wells]
+            image, config = make_plate(n_rows, n_columns)
+            path = os.path.join(directory, f"plate_{wells}.jpeg")
+            imsave(path, image)
+            samples, timing = measure(lambda: load_image(path), repeats)
+            results.append(dict(wells=wells, AoI_size=None, stage="decode", method=None, **timing))
+            grid = np.array(generate_grid(config))
+            rotated_config = rotate_config(config, 1)
+            rotated_grid = np.array(generate_grid(rotated_config))
+            rotated_axes = get_grid_axes(rotated_config)
+            # The plate stands in for the blank of a flat-field calibration, only the time matters
+            gain_map, timing = measure(lambda: build_gain_map(samples), repeats)
+            results.append(dict(wells=wells, AoI_size=None, stage="flat_field_map", method=None, **timing))
+            for AoI_size in AoI_sizes:
+                shape = get_AoI_shape({"AoI_size": AoI_size})
+                stack = get_AoI_pixels(samples, grid[:, 0], grid[:, 1], shape)
+                def extract_rotated_first():
+                    # The first image of a rotated grid also works out where its AoI pixels are
+                    ROTATED_AOI_CACHE.clear()
+                    get_AoI_pixels_rotated(samples, rotated_grid[:, 0], rotated_grid[:, 1], shape, rotated_axes)
+                timings = measure_alternately([
+                    lambda: get_AoI_pixels(samples, grid[:, 0], grid[:, 1], shape),
+                    lambda: get_AoI_pixels_rotated(samples, rotated_grid[:, 0], rotated_grid[:, 1], shape, rotated_axes),
+                    extract_rotated_first], repeats)
+                for stage, timing in zip(("extraction", "extraction_rotated", "extraction_rotated_first"), timings):
+                    results.append(dict(wells=wells, AoI_size=AoI_size, stage=stage, method=None, **timing))
+                disc = get_AoI_shape({"AoI_shape": "disc", "AoI_size": AoI_size})
+                _, timing = measure(lambda: get_AoI_pixels(samples, grid[:, 0], grid[:, 1], disc), repeats)
+                results.append(dict(wells=wells, AoI_size=AoI_size, stage="extraction_disc", method=None, **timing))
+                for aggregation_method in methods.aggregation_methods:
+                    samples_rgb, timing = measure(lambda: aggregation_method.calculate_batch(stack, shape), repeats)
+                    results.append(dict(wells=wells, AoI_size=AoI_size, stage="aggregation", method=aggregation_method.code, **timing))
+                _, timing = measure(lambda: apply_gain_map(stack, gain_map, grid[:, 0], grid[:, 1], samples.shape), repeats)
+                results.append(dict(wells=wells, AoI_size=AoI_size, stage="flat_field", method=None, **timing))
+                for scoring_method in methods.scoring_methods:
+                    # Color space conversions are part of scoring, so every repetition starts from plain RGB
+                    def score():
+                        samples = ColorSet(samples_rgb).prepare(scoring_method.color_spaces)
+                        control = ColorSet(samples_rgb[0]).prepare(scoring_method.color_spaces)
+                        return scoring_method.calculate_batch(samples, control)
+                    _, timing = measure(score, repeats)
+                    results.append(dict(wells=wells, AoI_size=AoI_size, stage="scoring", method=scoring_method.code, **timing))
+    return results
+
+def get_entry_key(entry):
+    return (entry["wells"], entry["AoI_size"], entry["stage"], entry["method"])
+
+def compare(results, previous, threshold):
+    # Prints every stage that got slower than threshold times its previous median
+    previous = {get_entry_key(entry): entry for entry in previous["results"]}
+    regressions = 0
+    for entry in results:
+        old = previous.get(get_entry_key(entry))
+        if old is None or not old["median"]:
+            continue
+        ratio = entry["median"]/old["median"]
+        if ratio > threshold:
+            regressions += 1
+            print(f"slower x{ratio:.2f}: {entry['stage']} {entry['method'] or ''} wells={entry['wells']} AoI={entry['AoI_size']}")
+    return regressions
+
+def check_rotated(results, limit):
+    # Prints every plate where extracting the AoIs of a rotated grid takes more than limit times the axis-aligned one
+    axis_aligned = {(entry["wells"], entry["AoI_size"]): entry["median"] for entry in results if entry["stage"] == "extraction"}
+    slow = 0
+    for entry in results:
+        if entry["stage"] != "extraction_rotated":
+            continue
+        reference = axis_aligned.get((entry["wells"], entry["AoI_size"]))
+        if not reference:
+            continue
+        ratio = entry["median"]/reference
+        if ratio > limit:
+            slow += 1
+            print(f"rotated x{ratio:.2f} of axis-aligned: extraction wells={entry['wells']} AoI={entry['AoI_size']}")
+    return slow
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="microtiter_benchmark", description="Time every stage of the evaluation pipeline on synthetic plates.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON file for the results (default: benchmark.json)")
+    parser.add_argument("--wells", type=int, nargs="+", default=list(PLATE_FORMATS), choices=list(PLATE_FORMATS), help="plate formats to run")
+    parser.add_argument("--AoI-sizes", type=int, nargs="+", default=AOI_SIZES, help="AoI sizes to run (default: 1 5 11 21 41)")
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="timed repetitions of every stage (default: 5)")
+    parser.add_argument("--compare", help="earlier benchmark JSON to report regressions against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression (default: 1.25)")
+    parser.add_argument("--rotated-limit", type=float, default=1.25, help="slowdown of rotated over axis-aligned AoI extraction reported as a regression (default: 1.25)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args.wells, args.AoI_sizes, args.repeats)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "image_size": [IMAGE_WIDTH, IMAGE_HEIGHT],
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Wrote {len(results)} timings to {args.output}")
+    regressions = check_rotated(results, args.rotated_limit)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            previous = json.load(file)
+        regressions += compare(results, previous, args.threshold)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
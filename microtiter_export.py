@@ -0,0 +1,174 @@
+import os
+import csv
+import importlib.util
+import numpy as np
+from microtiter_analysis import get_grid_corners, idx_to_letter
+
+# Structured results files with one row per plate: the image, the settings it was evaluated with and the full
+# precision score of every well. Plates can be added one by one or many at once, also to an existing file.
+# Parquet needs pyarrow, which is optional. Nothing in here may import PyQt6.
+
+TEXT_SETTINGS = ("path_control", "AoI_shape", "AoI_mask", "flat_field", "aggregation_method", "scoring_method")
+NUMBER_SETTINGS = ("top_left_x", "top_left_y", "top_right_x", "top_right_y", "bottom_left_x", "bottom_left_y", "bottom_right_x", "bottom_right_y",
+    "n_rows", "n_columns", "control_x", "control_y", "AoI_size", "AoI_inner_size")
+
+def get_well_names(n_rows, n_columns):
+    return [idx_to_letter(i) + str(j+1) for i in range(n_rows) for j in range(n_columns)]
+
+def get_settings_columns(configs):
+    # Every setting is a column, optional ones get the value they default to, so all files share one layout
+    columns = {"image": np.array([config["path_samples"] for config in configs])}
+    defaults = {"AoI_shape": "square", "AoI_mask": "", "flat_field": "", "AoI_inner_size": 0}
+    corners = [dict(zip(NUMBER_SETTINGS[:8], np.ravel(get_grid_corners(config)))) for config in configs]
+    for setting in TEXT_SETTINGS:
+        columns[setting] = np.array([str(config.get(setting, defaults.get(setting))) for config in configs])
+    for setting in NUMBER_SETTINGS:
+        columns[setting] = np.array([plate_corners.get(setting, config.get(setting, defaults.get(setting))) for config, plate_corners in zip(configs, corners)], dtype=float)
+    return columns
+
+class ResultsWriter:
+    # Adds plates to one results file, which is complete once the writer is closed
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+
+    def write(self, configs, scores):
+        # configs holds the config of every plate (with its path_samples), scores their (n_rows, n_columns) results
+        if isinstance(configs, dict):
+            configs = [configs]
+        if not configs:
+            return
+        well_names = get_well_names(configs[0]["n_rows"], configs[0]["n_columns"])
+        if any((config["n_rows"], config["n_columns"]) != (configs[0]["n_rows"], configs[0]["n_columns"]) for config in configs):
+            raise ValueError("All plates of a results file need the same number of rows and columns")
+        scores = np.asarray(scores, dtype=float).reshape(len(configs), len(well_names))
+        self.write_table(get_settings_columns(configs), well_names, scores)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+class CsvResultsWriter(ResultsWriter):
+    # Comma separated with a header row, every plate is on disk as soon as it is written
+    def __init__(self, path, append=False):
+        super().__init__(path, append)
+        self.header = None
+        if append and os.path.exists(path) and os.path.getsize(path):
+            with open(path, "r", newline="") as file:
+                self.header = next(csv.reader(file))
+        self.file = open(path, "a" if append else "w", newline="")
+        self.writer = csv.writer(self.file)
+
+    def write_table(self, columns, well_names, scores):
+        header = list(columns) + well_names
+        if self.header is None:
+            self.writer.writerow(header)
+            self.header = header
+        elif header != self.header:
+            raise ValueError("The plates do not match the columns of " + self.path)
+        # Floats are written by repr, which is the shortest text that reads back to the same value
+        settings = zip(*[column.tolist() for column in columns.values()])
+        self.writer.writerows(list(plate) + plate_scores for plate, plate_scores in zip(settings, scores.tolist()))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class NpzResultsWriter(ResultsWriter):
+    # One array per column plus scores as (plates, n_rows, n_columns). An archive cannot be added to in place,
+    # so the plates are collected and the archive, including the plates it already had, is written on close.
+    def __init__(self, path, append=False):
+        super().__init__(path, append)
+        self.tables = []
+        if append and os.path.exists(path):
+            with np.load(path) as archive:
+                self.tables.append({key: archive[key] for key in archive.files})
+
+    def write_table(self, columns, well_names, scores):
+        n_rows, n_columns = int(columns["n_rows"][0]), int(columns["n_columns"][0])
+        table = dict(columns, scores=scores.reshape(-1, n_rows, n_columns))
+        if self.tables and (set(table) != set(self.tables[0]) or table["scores"].shape[1:] != self.tables[0]["scores"].shape[1:]):
+            raise ValueError("The plates do not match the columns of " + self.path)
+        self.tables.append(table)
+
+    def close(self):
+        if not self.tables:
+            return
+        np.savez(self.path, **{key: np.concatenate([table[key] for table in self.tables]) for key in self.tables[0]})
+
+class ParquetResultsWriter(ResultsWriter):
+    # One column per setting and per well. Plates are written in row groups of row_group_plates, an existing
+    # file is read back first and rewritten in front of the new plates.
+    row_group_plates = 256
+
+    def __init__(self, path, append=False):
+        import pyarrow.parquet as pq
+        super().__init__(path, append)
+        self.writer = None
+        self.pending = []
+        self.existing = pq.read_table(path) if append and os.path.exists(path) else None
+
+    def write_table(self, columns, well_names, scores):
+        import pyarrow as pa
+        arrays = dict(columns)
+        arrays.update(zip(well_names, scores.T))
+        table = pa.table(arrays)
+        schema = self.existing.schema if self.existing is not None else table.schema
+        if table.schema.names != schema.names:
+            raise ValueError("The plates do not match the columns of " + self.path)
+        self.pending.append(table.cast(schema))
+        if sum(len(table) for table in self.pending) >= self.row_group_plates:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self.pending:
+            return
+        if self.writer is None:
+            # Opening the writer truncates the file, the plates it had were read in __init__
+            self.writer = pq.ParquetWriter(self.path, self.pending[0].schema)
+            if self.existing is not None:
+                self.writer.write_table(self.existing)
+        self.writer.write_table(pa.concat_tables(self.pending))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+RESULTS_FORMATS = {
+    ".csv": ("CSV files", CsvResultsWriter),
+    ".npz": ("NumPy archives", NpzResultsWriter),
+    ".parquet": ("Parquet files", ParquetResultsWriter),
+}
+
+def is_parquet_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+def get_results_formats():
+    # Extension -> label of the formats that can be written here
+    return {extension: label for extension, (label, _) in RESULTS_FORMATS.items() if extension != ".parquet" or is_parquet_available()}
+
+def get_results_writer_class(path):
+    # The writer for the extension of path, checked before any plate is evaluated
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in RESULTS_FORMATS:
+        raise ValueError("Unknown results format " + repr(extension) + ", use one of " + ", ".join(RESULTS_FORMATS))
+    if extension == ".parquet" and not is_parquet_available():
+        raise ValueError("Writing Parquet files needs pyarrow (pip install pyarrow)")
+    return RESULTS_FORMATS[extension][1]
+
+def open_results_writer(path, append=False):
+    return get_results_writer_class(path)(path, append)
+
+def export_results(path, configs, scores, append=False):
+    with open_results_writer(path, append) as writer:
+        writer.write(configs, scores)
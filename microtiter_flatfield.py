@@ -0,0 +1,137 @@
+import os
+import sys
+import argparse
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Flat-field correction of uneven illumination (vignetting) from a gain map, calibrated once per reader from an
+# image of a blank plate. Only the AoI pixels are corrected, each AoI with the gain at its center.
+# Build a map with: python -m microtiter_flatfield blank.jpeg -o reader.npz
+# Nothing in here may import PyQt6.
+
+class GainMap:
+    def __init__(self, gains, factor, image_shape):
+        # (blocks down, blocks across, 3) float16 gains, the block size in pixels and the (height, width) of the blank
+        self.gains = gains
+        self.factor = int(factor)
+        self.image_shape = tuple(int(size) for size in image_shape)
+
+    def fits(self, image_shape):
+        return tuple(image_shape[:2]) == self.image_shape
+
+    def get_gains(self, xs, ys):
+        # (len(xs), 3) gains at the given centers, interpolated bilinearly between the block centers
+        rows, row_weights = self.get_neighbours(ys, self.gains.shape[0])
+        columns, column_weights = self.get_neighbours(xs, self.gains.shape[1])
+        top = self.gains[rows[0], columns[0]]*(1 - column_weights) + self.gains[rows[0], columns[1]]*column_weights
+        bottom = self.gains[rows[1], columns[0]]*(1 - column_weights) + self.gains[rows[1], columns[1]]*column_weights
+        return top*(1 - row_weights) + bottom*row_weights
+
+    def get_neighbours(self, positions, blocks):
+        # Blocks before and after every position along one axis, and the weight of the one after
+        position = np.clip((np.asarray(positions, dtype=float) - (self.factor - 1)/2)/self.factor, 0, blocks - 1)
+        before = np.floor(position).astype(np.intp)
+        after = np.minimum(before + 1, blocks - 1)
+        return (before, after), (position - before)[:, None]
+
+def get_block_means(image, factor):
+    # Mean of every factor x factor block per channel, the blocks at the right and bottom edges may be smaller
+    height, width = image.shape[:2]
+    row_starts = np.arange(0, height, factor)
+    column_starts = np.arange(0, width, factor)
+    sums = np.add.reduceat(np.add.reduceat(image, row_starts, axis=0, dtype=np.uint32), column_starts, axis=1)
+    counts = np.outer(np.diff(np.append(row_starts, height)), np.diff(np.append(column_starts, width)))
+    return sums/counts[:, :, None]
+
+def smooth_blocks(means, radius):
+    # Moving average over (2*radius+1) blocks in both directions, so the wells and their walls in the blank
+    # plate do not end up in the map, only the illumination they are lit by
+    for axis in (0, 1):
+        padded = np.pad(means, [(radius, radius) if idx == axis else (0, 0) for idx in range(3)], mode="edge")
+        cumulative = np.cumsum(padded, axis=axis)
+        cumulative = np.insert(cumulative, 0, 0, axis=axis)
+        length = means.shape[axis]
+        means = (np.take(cumulative, np.arange(2*radius+1, 2*radius+1+length), axis=axis) - np.take(cumulative, np.arange(length), axis=axis))/(2*radius+1)
+    return means
+
+def build_gain_map(blank, factor=16, smoothing=2, limit=4.0):
+    # Gains bringing every block of the blank to the mean brightness of its channel. Black or saturated blocks
+    # (e.g. outside of the plate holder) are clipped to limit, so they cannot blow up an AoI.
+    blank = np.asarray(blank)[:, :, :3]
+    means = smooth_blocks(get_block_means(blank, factor), smoothing)
+    gains = means.mean(axis=(0, 1))/np.maximum(means, 1)
+    gains = np.clip(gains, 1/limit, limit)
+    return GainMap(gains.astype(np.float16), factor, blank.shape[:2])
+
+def save_gain_map(path, gain_map):
+    with open(path, "wb") as file:
+        np.savez_compressed(file, gains=gain_map.gains, factor=gain_map.factor, image_shape=gain_map.image_shape)
+
+def load_gain_map(path):
+    with np.load(path) as archive:
+        return GainMap(archive["gains"], archive["factor"], archive["image_shape"])
+
+def apply_gain_map(stack, gain_map, xs, ys, image_shape):
+    # Corrects every pixel of the (wells, pixels, 3) AoIs around the (xs, ys) centers, rounded and no brighter than white
+    if not gain_map.fits(image_shape):
+        raise ValueError(f"The flat-field map was made for {gain_map.image_shape[1]} x {gain_map.image_shape[0]} images, not {image_shape[1]} x {image_shape[0]}")
+    corrected = np.multiply(stack, gain_map.get_gains(xs, ys).astype(np.float32)[:, None, :], dtype=np.float32)
+    corrected += 0.5
+    np.minimum(corrected, 255, out=corrected)
+    return corrected.astype(np.uint8)
+
+class GainMapCache:
+    # Loaded gain maps keyed by path, reloaded once the file changes
+    def __init__(self, limit=4):
+        self.entries = OrderedDict()
+        self.limit = limit
+        # Evaluation workers and the GUI thread load maps concurrently
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            gain_map = load_gain_map(path)
+            self.entries[key] = gain_map
+            if len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+            return gain_map
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+GAIN_MAP_CACHE = GainMapCache()
+
+def get_gain_map(config):
+    # Gain map of the optional flat_field setting, None without one
+    path = config.get("flat_field")
+    if not path:
+        return None
+    return GAIN_MAP_CACHE.get(path)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="microtiter_flatfield", description="Build a flat-field gain map from an image of a blank plate.")
+    parser.add_argument("blank", help="image of a blank plate, taken with the reader and settings of the plates to correct")
+    parser.add_argument("-o", "--output", help="gain map file (default: the blank image name with .npz)")
+    parser.add_argument("--factor", type=int, default=16, help="pixels per block of the map in both directions (default: 16)")
+    parser.add_argument("--smoothing", type=int, default=2, help="blocks averaged on every side of a block (default: 2)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    from microtiter_analysis import load_image
+    args = parse_args(argv)
+    output = args.output or os.path.splitext(args.blank)[0] + ".npz"
+    gain_map = build_gain_map(load_image(args.blank), args.factor, args.smoothing)
+    save_gain_map(output, gain_map)
+    gains = gain_map.gains.astype(float)
+    print(f"Gain map of {gains.shape[1]} x {gains.shape[0]} blocks written to {output}, gains {gains.min():.2f} to {gains.max():.2f}")
+    print(f"Set \"flat_field\": \"{output}\" in config.json to use it")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
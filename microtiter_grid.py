@@ -0,0 +1,141 @@
+import numpy as np
+from microtiter_profiling import profiler
+
+# Automatic well grid detection, and the homography helpers the grid model of microtiter_analysis uses.
+# The plate is searched on a downsampled copy: the autocorrelation of its edges gives the spacing and
+# direction of the rows and columns, circles fitted to the well rims (Hough transform) locate the wells, and
+# a homography from (column, row) indices to pixels is fitted to them, so small rotations and perspective
+# are absorbed. Nothing in here may import PyQt6.
+
+DETECTION_SIZE = 512  # Longer side of the downsampled copy, in pixels
+
+def detect_grid(image, n_rows, n_columns):
+    # Returns the 3x3 homography mapping (column, row) well indices to (x, y) pixels of image
+    from skimage.color import rgb2gray
+    from skimage.feature import canny
+    from skimage.filters import sobel
+    from skimage.transform import hough_circle
+    if n_rows < 2 or n_columns < 2:
+        raise ValueError(f"Grid detection needs at least 2 rows and 2 columns, not {n_rows} x {n_columns}")
+    with profiler.stage("grid detection"):
+        height, width = image.shape[:2]
+        step = max(1, round(max(height, width)/DETECTION_SIZE))
+        gray = rgb2gray(np.asarray(image[::step, ::step]))
+        column_step, row_step = get_lattice(sobel(gray))
+        pitch = min(np.hypot(*column_step), np.hypot(*row_step))
+        # Well centers of the plate have to lie in the image, at the spacing found in it
+        if (n_columns - 1)*abs(column_step[0]) >= gray.shape[1] or (n_rows - 1)*abs(row_step[1]) >= gray.shape[0]:
+            raise ValueError(f"{n_rows} x {n_columns} wells do not fit in the image at the well spacing found in it ({round(np.hypot(*column_step)*step)} x {round(np.hypot(*row_step)*step)} pixels)")
+        # Best circle through the rims around every pixel, for radii up to half the spacing
+        radii = np.unique(np.linspace(max(2, 0.2*pitch), 0.5*pitch, 12).astype(int))
+        circles = hough_circle(canny(gray, sigma=1), radii).max(axis=0)
+        window = max(3, int(0.5*pitch) | 1)
+        # Lattice nodes covering the whole image, anchored at the strongest circle
+        anchor_y, anchor_x = np.unravel_index(circles.argmax(), circles.shape)
+        reach = int(max(gray.shape)/pitch) + 1
+        rows, columns = np.mgrid[-reach:reach+1, -reach:reach+1]
+        nodes = np.array([anchor_x, anchor_y]) + columns[..., None]*column_step + rows[..., None]*row_step
+        node_scores, _ = get_peaks(circles, nodes.reshape(-1, 2), window)
+        node_scores = node_scores.reshape(rows.shape)
+        # The plate is the n_rows x n_columns block of nodes with the strongest circles
+        sums = np.pad(node_scores.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+        block_sums = sums[n_rows:, n_columns:] - sums[:-n_rows, n_columns:] - sums[n_rows:, :-n_columns] + sums[:-n_rows, :-n_columns]
+        first_row, first_column = np.unravel_index(block_sums.argmax(), block_sums.shape)
+        indices = np.stack(np.meshgrid(np.arange(n_columns), np.arange(n_rows)), axis=-1).reshape(-1, 2).astype(float)
+        homography = fit_homography(indices, nodes[first_row:first_row+n_rows, first_column:first_column+n_columns].reshape(-1, 2))
+        # Move every well onto its nearest circle and refit, dropping wells that disagree with the others
+        for _ in range(4):
+            predicted = apply_homography(homography, indices)
+            _, found = get_peaks(circles, predicted, window)
+            residuals = np.hypot(*(found - predicted).T)
+            inliers = residuals <= max(3*np.median(residuals), 1)
+            homography = fit_homography(indices[inliers], found[inliers])
+        if inliers.sum() < max(4, len(indices)//2):
+            raise ValueError("No well grid found in the image")
+        return np.diag([step, step, 1.0]) @ homography
+
+def get_lattice(edges):
+    # Column and row steps of the strongest periodic pattern, from the peaks of the edge autocorrelation
+    from skimage.feature import peak_local_max
+    edges = edges - edges.mean()
+    height, width = edges.shape
+    spectrum = np.fft.rfft2(edges, s=(2*height, 2*width))
+    # Displacements with dy >= 0 only, dx centered, as the autocorrelation is symmetric
+    correlation = np.fft.fftshift(np.fft.irfft2(np.abs(spectrum)**2)[:height], axes=1)
+    peaks = peak_local_max(correlation, min_distance=3, num_peaks=60, exclude_border=False)
+    vectors = np.stack([peaks[:, 1] - correlation.shape[1]//2, peaks[:, 0]], axis=1).astype(float)
+    strengths = correlation[peaks[:, 0], peaks[:, 1]]
+    lengths = np.hypot(*vectors.T)
+    order = np.argsort(lengths)
+    vectors, strengths, lengths = vectors[order], strengths[order], lengths[order]
+    vectors, strengths = vectors[lengths > 2], strengths[lengths > 2]
+    if not len(vectors):
+        raise ValueError("No well grid found in the image")
+    strong = vectors[strengths > 0.5*strengths.max()]
+    first = strong[0]
+    second = next((vector for vector in strong[1:] if abs(first[0]*vector[1] - first[1]*vector[0]) > 0.7*np.hypot(*first)*np.hypot(*vector)), None)
+    if second is None:
+        raise ValueError("No well grid found in the image")
+    column_step, row_step = (first, second) if abs(first[0]) > abs(first[1]) else (second, first)
+    basis = np.stack([column_step*np.sign(column_step[0]), row_step*np.sign(row_step[1])])
+    # Refine with every peak close to a lattice point, farther peaks pin the steps down more precisely
+    multiples = np.rint(vectors @ np.linalg.inv(basis))
+    close = np.hypot(*(multiples @ basis - vectors).T) < 0.2*min(np.hypot(*basis[0]), np.hypot(*basis[1]))
+    close &= np.abs(multiples).sum(axis=1) > 0
+    basis = np.linalg.lstsq(multiples[close], vectors[close], rcond=None)[0]
+    return basis[0], basis[1]
+
+def get_peaks(values, points, size):
+    # Maximum of values in the size x size window around every (x, y) point, and where it is
+    height, width = values.shape
+    offsets = np.arange(size) - size//2
+    points = np.rint(points).astype(int)
+    rows = np.clip(points[:, 1, None] + offsets, 0, height-1)
+    columns = np.clip(points[:, 0, None] + offsets, 0, width-1)
+    windows = values[rows[:, :, None], columns[:, None, :]].reshape(len(points), -1)
+    inside = (points[:, 0] >= 0) & (points[:, 0] < width) & (points[:, 1] >= 0) & (points[:, 1] < height)
+    best = windows.argmax(axis=1)
+    found = np.stack([columns[np.arange(len(points)), best % size], rows[np.arange(len(points)), best//size]], axis=1)
+    return windows.max(axis=1)*inside, found.astype(float)
+
+def fit_homography(source, target):
+    # Least squares (DLT) homography mapping source points onto target points, on normalized coordinates
+    source_normalization = get_normalization(source)
+    target_normalization = get_normalization(target)
+    x, y = apply_homography(source_normalization, source).T
+    u, v = apply_homography(target_normalization, target).T
+    zeros = np.zeros_like(x)
+    ones = np.ones_like(x)
+    equations = np.concatenate([
+        np.stack([x, y, ones, zeros, zeros, zeros, -u*x, -u*y, -u], axis=1),
+        np.stack([zeros, zeros, zeros, x, y, ones, -v*x, -v*y, -v], axis=1),
+    ])
+    # The null vector is the last row of vt, which the reduced SVD leaves out for exactly four points
+    _, _, vt = np.linalg.svd(equations, full_matrices=len(equations) < 9)
+    homography = np.linalg.inv(target_normalization) @ vt[-1].reshape(3, 3) @ source_normalization
+    return homography/homography[2, 2]
+
+def get_normalization(points):
+    # Moves the points to the origin and scales them to a mean distance of sqrt(2)
+    center = points.mean(axis=0)
+    scale = np.sqrt(2)/max(np.hypot(*(points - center).T).mean(), 1e-12)
+    return np.array([[scale, 0, -scale*center[0]], [0, scale, -scale*center[1]], [0, 0, 1]])
+
+def apply_homography(homography, points):
+    points = np.asarray(points, dtype=float)
+    mapped = points @ homography[:, :2].T + homography[:, 2]
+    return mapped[:, :2]/mapped[:, 2:]
+
+def get_detected_config(config, image):
+    # Copy of config with the four corner wells snapped to the grid detected in image
+    homography = detect_grid(image, config["n_rows"], config["n_columns"])
+    last_column = config["n_columns"] - 1
+    last_row = config["n_rows"] - 1
+    corners = apply_homography(homography, [[0, 0], [last_column, 0], [0, last_row], [last_column, last_row]])
+    corners = np.rint(corners).astype(int).tolist()
+    names = ["top_left", "top_right", "bottom_left", "bottom_right"]
+    detected = dict(config)
+    for name, (x, y) in zip(names, corners):
+        detected[name+"_x"] = x
+        detected[name+"_y"] = y
+    return detected
@@ -1,10 +1,25 @@
+import os
 import sys
 import json
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QScrollArea, QGroupBox, QWidget, QRadioButton, QButtonGroup, QDialogButtonBox, QDialog, QFileDialog, QPushButton, QLabel, QLineEdit, QTextEdit, QSpinBox, QVBoxLayout, QHBoxLayout, QGridLayout
+from PyQt6.QtWidgets import QApplication, QMainWindow, QTabWidget, QScrollArea, QGroupBox, QWidget, QRadioButton, QCheckBox, QDoubleSpinBox, QButtonGroup, QDialogButtonBox, QDialog, QFileDialog, QPushButton, QLabel, QLineEdit, QTextEdit, QSpinBox, QComboBox, QVBoxLayout, QHBoxLayout, QGridLayout
 from PyQt6.QtGui import QImage, QPixmap, QColor, QPainter, QPen
-from PyQt6.QtCore import Qt, QSize, pyqtSignal, QPoint, QRectF
+from PyQt6.QtCore import Qt, QSize, QThread, QTimer, pyqtSignal, QPoint, QRect, QRectF, QLineF
 from microtiter_methods import MicrotiterMethods
+from microtiter_profiling import Profiler, profiler
+from microtiter_raw import is_raw, open_raw, convert_to_raw, get_preview_path, write_preview
+from microtiter_grid import get_detected_config
+from microtiter_analyzer import PlateEvaluator
+from microtiter_watch import FolderWatcher, PlateWatch, process_timed, get_status_string
+from microtiter_export import get_results_formats, export_results
+from microtiter_store import ResultStore
+from microtiter_flatfield import GAIN_MAP_CACHE, build_gain_map, save_gain_map, load_gain_map
+from microtiter_aoi import AOI_SHAPES, AOI_SHAPE_SETTINGS, get_AoI_shape
+from microtiter_analysis import aggregate_control_references, has_control_references, evaluate_references, get_references_string, get_reference_label, parse_well
+from microtiter_analysis import AggregationCache, GRID_CORNERS, get_grid_corners, get_grid_spacing, is_axis_aligned, evaluate_plate, evaluate_plates, get_kinetics, get_kinetics_string, load_image, aggregate_control, aggregate_wells, score_colors, generate_grid, get_AoI, get_results_string, idx_to_letter
 
 class MainWindow(QMainWindow):
     config_loaded_signal = pyqtSignal()
@@ -26,6 +41,20 @@ class MainWindow(QMainWindow):
         load_config_action.triggered.connect(self.load_config)
         save_config_action = menu.addAction("Save config")
         save_config_action.triggered.connect(self.save_config)
+        tools_menu = menubar.addMenu('Tools')
+        convert_action = tools_menu.addAction("Convert scan to raw frame")
+        convert_action.triggered.connect(self.convert_scan)
+        clear_store_action = tools_menu.addAction("Clear result store")
+        clear_store_action.triggered.connect(self.clear_result_store)
+        forget_samples_action = tools_menu.addAction("Forget stored results of the samples image")
+        forget_samples_action.triggered.connect(self.forget_samples_results)
+        tools_menu.addSeparator()
+        build_flat_field_action = tools_menu.addAction("Build flat-field map from blank plate")
+        build_flat_field_action.triggered.connect(self.build_flat_field)
+        select_flat_field_action = tools_menu.addAction("Use flat-field map")
+        select_flat_field_action.triggered.connect(self.select_flat_field)
+        clear_flat_field_action = tools_menu.addAction("Stop flat-field correction")
+        clear_flat_field_action.triggered.connect(lambda: self.set_flat_field(None))
 
     def load_config(self):
         config = {}
@@ -52,6 +81,10 @@ class MainWindow(QMainWindow):
             }
             msg_box = MessageBox("No config found   ", "Using default values.")
             msg_box.exec()
+        # Corners of a rotated grid, the AoI shape, the references and the flat-field map are optional,
+        # a new config must not inherit them
+        for setting in GRID_CORNERS + AOI_SHAPE_SETTINGS + ("references", "flat_field"):
+            self.config.pop(setting, None)
         self.config.update(config)
         self.config_loaded_signal.emit()
     
@@ -59,7 +92,75 @@ class MainWindow(QMainWindow):
         with open("config.json", "w") as file:
             json.dump(self.config, file, indent=4)
     
+    def convert_scan(self):
+        file_name = QFileDialog.getOpenFileName(self, "Select Scan to Convert", "", "Image files (*.*)")[0]
+        if file_name:
+            raw_path = convert_to_raw(file_name)
+            msg_box = MessageBox("Scan converted", "Raw frame written to " + raw_path + "\nSelect it as the samples or control image.")
+            msg_box.exec()
+
+    def clear_result_store(self):
+        store = self.central_widget.processing_tab.result_store
+        if store is not None:
+            store.clear()
+        self.central_widget.processing_tab.aggregation_cache.clear()
+
+    def forget_samples_results(self):
+        # For an image that was replaced in place, or results that must be computed again
+        processing_tab = self.central_widget.processing_tab
+        processing_tab.aggregation_cache.clear()
+        if processing_tab.result_store is None:
+            return
+        try:
+            removed = processing_tab.result_store.invalidate(self.config["path_samples"])
+        except OSError as error:
+            msg_box = MessageBox("Forgetting results failed", str(error))
+            msg_box.exec()
+            return
+        msg_box = MessageBox("Results forgotten", str(removed) + " stored results of " + self.config["path_samples"] + " removed.")
+        msg_box.exec()
+
+    def build_flat_field(self):
+        # Calibrates the reader once from a blank plate, the map is saved and used for every plate from then on
+        file_name = QFileDialog.getOpenFileName(self, "Select Image of a Blank Plate", "", "Image files (*.*)")[0]
+        if not file_name:
+            return
+        output = QFileDialog.getSaveFileName(self, "Save Flat-Field Map", os.path.splitext(file_name)[0] + ".npz", "Gain maps (*.npz)")[0]
+        if not output:
+            return
+        try:
+            save_gain_map(output, build_gain_map(load_image(file_name)))
+        except (OSError, ValueError) as error:
+            msg_box = MessageBox("Flat-field map failed", str(error))
+            msg_box.exec()
+            return
+        self.set_flat_field(output)
+        msg_box = MessageBox("Flat-field map built", "Gain map written to " + output + "\nIt is used from now on, save the config to keep it.")
+        msg_box.exec()
+
+    def select_flat_field(self):
+        file_name = QFileDialog.getOpenFileName(self, "Select Flat-Field Map", "", "Gain maps (*.npz)")[0]
+        if not file_name:
+            return
+        try:
+            load_gain_map(file_name)
+        except (OSError, ValueError, KeyError) as error:
+            msg_box = MessageBox("Invalid flat-field map", file_name + " is not a gain map built from a blank plate.\n" + str(error))
+            msg_box.exec()
+            return
+        self.set_flat_field(file_name)
+
+    def set_flat_field(self, path):
+        if path:
+            self.config["flat_field"] = path
+        else:
+            self.config.pop("flat_field", None)
+        # A map rebuilt under the same name must not be served from memory
+        GAIN_MAP_CACHE.clear()
+        self.central_widget.processing_tab.aggregation_cache.clear()
+
     def closeEvent(self, a0):
+        self.central_widget.processing_tab.stop_evaluations()
         print(self.config)
 
 class MessageBox(QDialog):
@@ -82,19 +183,417 @@ class MessageBox(QDialog):
     def accept(self):
         super().accept()
 
+class ImageBits:
+    # Exposes the read-only bits of a QImage to NumPy, the resulting array keeps the image alive through its base
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = {
+            "shape": (image.height(), image.bytesPerLine()),
+            "typestr": "|u1",
+            "data": (int(image.constBits()), True),
+            "version": 3,
+        }
+
+class ImageBuffer:
+    # Converts a QImage once to RGB888 and exposes its bits as an (H, W, 3) uint8 array without copying
+    def __init__(self, image):
+        self.image = image.convertToFormat(QImage.Format.Format_RGB888)
+        self.width = self.image.width()
+        self.height = self.image.height()
+        if self.image.isNull():
+            self.array = np.zeros((0, 0, 3), dtype=np.uint8)
+            return
+        # Scanlines are padded to 4 bytes, so view the whole line and cut the padding off
+        lines = np.asarray(ImageBits(self.image))
+        self.array = lines[:, :self.width*3].reshape(self.height, self.width, 3)
+
+    def get_AoI(self, x, y, size):
+        return get_AoI(self.array, x, y, size)
+
+    def get_rgb(self, x, y):
+        r, g, b = self.get_AoI(x, y, 1)[0, 0]
+        return int(r), int(g), int(b)
+
+class RawImageBuffer(ImageBuffer):
+    # Same interface over a memory-mapped raw frame, AoI reads only page in the rows they touch
+    def __init__(self, array):
+        self.image = None
+        self.array = array
+        self.height, self.width = array.shape[:2]
+
+class ImagePyramid:
+    # Display levels of an image, each half the size of the previous one, cut into tiles.
+    # Levels and tile pixmaps are made on first use, so only what has been on screen is ever converted.
+    tile_size = 512
+
+    def __init__(self, image, full_width, on_grow=None):
+        self.levels = [image]
+        self.tiles = {}
+        # Width of the image the coordinates refer to, level 0 is smaller for raw frames
+        self.full_width = full_width
+        self.on_grow = on_grow
+
+    def grow(self, size):
+        if self.on_grow:
+            self.on_grow(size)
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            image = self.levels[-1]
+            image = image.scaled(max(1, image.width()//2), max(1, image.height()//2), Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            self.levels.append(image)
+            self.grow(image.sizeInBytes())
+        return self.levels[level]
+
+    def get_level_scale(self, level):
+        # Full resolution pixels per pixel of the level
+        return self.full_width / self.get_level(level).width()
+
+    def choose_level(self, zoom):
+        # Smallest level that still has at least one pixel per display pixel
+        level = 0
+        while self.get_level_scale(level)*zoom < 0.5 and self.get_level(level).width() > self.tile_size:
+            level += 1
+        return level
+
+    def get_tile(self, level, column, row):
+        key = (level, column, row)
+        if key not in self.tiles:
+            image = self.get_level(level)
+            rect = QRect(column*self.tile_size, row*self.tile_size, self.tile_size, self.tile_size).intersected(image.rect())
+            tile = QPixmap.fromImage(image.copy(rect))
+            self.tiles[key] = tile
+            self.grow(tile.width()*tile.height()*tile.depth()//8)
+        return self.tiles[key]
+
+class ImageCacheEntry:
+    def __init__(self, image, raw=False):
+        self.image = image
+        # For raw frames image is only the downsampled preview, the pixels come from the memory map
+        self.raw = raw
+        self.buffer = None
+        self.pyramid = None
+        self.size = image.sizeInBytes()
+
+class ImageCache:
+    # LRU cache of decoded images, their array buffers and display pyramids, shared by all tabs.
+    # Entries are keyed by (path, mtime, size), so an overwritten file is decoded again.
+    def __init__(self, limit_bytes=512*1024*1024):
+        self.entries = OrderedDict()
+        self.limit_bytes = limit_bytes
+        self.used_bytes = 0
+
+    def get_key(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def get_entry(self, path):
+        key = self.get_key(path)
+        if key is None:
+            return None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        raw = is_raw(path)
+        if raw and not os.path.exists(get_preview_path(path)):
+            write_preview(path)
+        with profiler.stage("decode"):
+            image = QImage(get_preview_path(path) if raw else path)
+        if image.isNull():
+            return None
+        entry = ImageCacheEntry(image, raw)
+        self.entries[key] = entry
+        self.add_bytes(entry.size)
+        return entry
+
+    def get_image(self, path):
+        entry = self.get_entry(path)
+        return entry.image if entry else QImage()
+
+    def get_buffer(self, path):
+        entry = self.get_entry(path)
+        if not entry:
+            return ImageBuffer(QImage())
+        if entry.buffer is None and entry.raw:
+            entry.buffer = RawImageBuffer(open_raw(path))
+        if entry.buffer is None:
+            with profiler.stage("conversion"):
+                entry.buffer = ImageBuffer(entry.image)
+            entry.size += entry.buffer.image.sizeInBytes()
+            self.add_bytes(entry.buffer.image.sizeInBytes())
+        return entry.buffer
+
+    def get_pyramid(self, path):
+        entry = self.get_entry(path)
+        if not entry:
+            return None
+        if entry.pyramid is None:
+            entry.pyramid = ImagePyramid(entry.image, self.get_buffer(path).width, lambda size: self.grow_entry(entry, size))
+        return entry.pyramid
+
+    def grow_entry(self, entry, size):
+        # Tiles keep being made while the entry is on screen, an evicted entry is no longer counted
+        entry.size += size
+        if any(cached is entry for cached in self.entries.values()):
+            self.add_bytes(size)
+
+    def add_bytes(self, size):
+        self.used_bytes += size
+        # Evict least recently used images, but never the one that is just being used
+        while self.used_bytes > self.limit_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.used_bytes -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+class ImageView(QWidget):
+    # Zoomable view of an ImagePyramid that paints only the tiles in the exposed area, with crosses
+    # and well rectangles on top. Wheel zooms around the cursor, right or middle button drags pan.
+    pixel_clicked = pyqtSignal(int, int)
+    zoom_changed = pyqtSignal()
+    zoom_range = (0.02, 8)
+
+    def __init__(self, scroll_area):
+        super().__init__()
+        self.scroll_area = scroll_area
+        self.pyramid = None
+        self.full_width = 1
+        self.full_height = 1
+        self.zoom = 1
+        self.crosses = []
+        self.rects = []
+        # Display coordinates of the overlay, prepared on the first paint after the overlay or the zoom changes
+        self.cross_lines = None
+        self.overlay_rects = None
+        self.pan_origin = None
+
+    def set_pyramid(self, pyramid, full_width, full_height, fit_width):
+        if pyramid is self.pyramid:
+            return
+        self.pyramid = pyramid
+        self.full_width = full_width
+        self.full_height = full_height
+        self.set_zoom(fit_width / full_width)
+
+    def set_overlay(self, crosses, rects=()):
+        # crosses are (x, y) and rects (x, y, size, color), all in full resolution pixels
+        self.crosses = crosses
+        self.rects = rects
+        self.cross_lines = None
+        self.overlay_rects = None
+        self.update()
+
+    def set_zoom(self, zoom, anchor=None):
+        zoom = min(max(zoom, self.zoom_range[0]), self.zoom_range[1])
+        if anchor is None:
+            anchor = QPoint(0, 0)
+        # Keep the image point under the anchor where it is on screen
+        horizontal = self.scroll_area.horizontalScrollBar()
+        vertical = self.scroll_area.verticalScrollBar()
+        view_x = anchor.x() - horizontal.value()
+        view_y = anchor.y() - vertical.value()
+        image_x = anchor.x() / self.zoom
+        image_y = anchor.y() / self.zoom
+        self.zoom = zoom
+        self.cross_lines = None
+        self.overlay_rects = None
+        self.setFixedSize(max(1, round(self.full_width*zoom)), max(1, round(self.full_height*zoom)))
+        horizontal.setValue(round(image_x*zoom - view_x))
+        vertical.setValue(round(image_y*zoom - view_y))
+        self.update()
+        self.zoom_changed.emit()
+
+    def paintEvent(self, event):
+        if self.pyramid is None:
+            return
+        painter = QPainter(self)
+        level = self.pyramid.choose_level(self.zoom)
+        image = self.pyramid.get_level(level)
+        # Display pixels per pixel of the level
+        level_zoom = self.zoom * self.pyramid.get_level_scale(level)
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, level_zoom < 1)
+        tile_size = self.pyramid.tile_size
+        exposed = event.rect()
+        first_column = max(0, int(exposed.left()/level_zoom) // tile_size)
+        last_column = min((image.width()-1) // tile_size, int(exposed.right()/level_zoom) // tile_size)
+        first_row = max(0, int(exposed.top()/level_zoom) // tile_size)
+        last_row = min((image.height()-1) // tile_size, int(exposed.bottom()/level_zoom) // tile_size)
+        for row in range(first_row, last_row+1):
+            for column in range(first_column, last_column+1):
+                tile = self.pyramid.get_tile(level, column, row)
+                target = QRectF(column*tile_size*level_zoom, row*tile_size*level_zoom, tile.width()*level_zoom, tile.height()*level_zoom)
+                painter.drawPixmap(target, tile, QRectF(tile.rect()))
+        self.paint_overlay(painter)
+        painter.end()
+
+    def paint_overlay(self, painter):
+        self.prepare_overlay()
+        painter.setPen(Qt.PenStyle.NoPen)
+        for rect, color in self.overlay_rects:
+            painter.setBrush(color)
+            painter.drawRect(rect)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, False)
+        painter.setPen(QPen(QColor(0, 255, 0), 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
+        painter.drawLines(self.cross_lines)
+
+    def prepare_overlay(self):
+        if self.cross_lines is None:
+            cross_size = 10  # Fixed display pixels
+            centers = np.rint(np.asarray(self.crosses, dtype=float).reshape(-1, 2)*self.zoom)
+            x, y = centers[:, 0], centers[:, 1]
+            # Both arms of every cross, one (x1, y1, x2, y2) row per line
+            lines = np.stack([x-cross_size, y, x+cross_size, y, x, y-cross_size, x, y+cross_size], axis=1).reshape(-1, 4)
+            self.cross_lines = [QLineF(*line) for line in lines.tolist()]
+        if self.overlay_rects is None:
+            self.overlay_rects = [(QRectF((x - size/2)*self.zoom, (y - size/2)*self.zoom, size*self.zoom, size*self.zoom), color) for x, y, size, color in self.rects]
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.set_zoom(self.zoom * 1.25**steps, event.position().toPoint())
+        event.accept()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton:
+            self.pixel_clicked.emit(round(event.position().x()/self.zoom), round(event.position().y()/self.zoom))
+        else:
+            self.pan_origin = event.globalPosition().toPoint()
+
+    def mouseMoveEvent(self, event):
+        if self.pan_origin is None:
+            return
+        position = event.globalPosition().toPoint()
+        delta = position - self.pan_origin
+        self.pan_origin = position
+        self.scroll_area.horizontalScrollBar().setValue(self.scroll_area.horizontalScrollBar().value() - delta.x())
+        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().value() - delta.y())
+
+    def mouseReleaseEvent(self, event):
+        self.pan_origin = None
+
+class EvaluationWorker(QThread):
+    # Scores a plate off the GUI thread, all wells per stage in one batch, cancelled through requestInterruption()
+    stage_finished = pyqtSignal(int, str)
+    evaluation_finished = pyqtSignal(int, object, object)
+    evaluation_failed = pyqtSignal(int, str)
+
+    def __init__(self, job_id, config, samples, control, methods, job_profiler):
+        super().__init__()
+        self.job_id = job_id
+        # Settings are copied, so changes made during the run do not leak into it
+        self.config = dict(config)
+        self.samples = samples
+        self.control = control
+        self.methods = methods
+        self.profiler = job_profiler
+        self.aggregation_key = None
+
+    def run(self):
+        with self.profiler.bind():
+            self.evaluate()
+
+    def evaluate(self):
+        try:
+            control_colors = aggregate_control(self.config, self.control, self.methods)
+            self.stage_finished.emit(self.job_id, "Control aggregated")
+            if self.isInterruptionRequested():
+                return
+            samples_rgb = aggregate_wells(self.config, self.samples, self.methods, np.array(generate_grid(self.config)))
+            self.stage_finished.emit(self.job_id, str(len(samples_rgb)) + " wells aggregated")
+            if self.isInterruptionRequested():
+                return
+            # Color conversions run once for the whole plate
+            results = score_colors(self.config, samples_rgb, control_colors, self.methods)
+        except Exception as error:
+            # An exception escaping run() aborts the whole application, so every failure is reported instead
+            self.evaluation_failed.emit(self.job_id, str(error))
+            return
+        shape = (self.config["n_rows"], self.config["n_columns"])
+        self.evaluation_finished.emit(self.job_id, results.reshape(shape), samples_rgb.reshape(shape + (3,)))
+
+class SeriesEvaluationWorker(QThread):
+    # Reads and aggregates the plates of a series one by one, then scores all of them in one pass
+    plate_evaluated = pyqtSignal(int, int)
+    series_finished = pyqtSignal(int, object)
+    series_failed = pyqtSignal(int, str)
+
+    def __init__(self, job_id, config, paths, control, methods, job_profiler):
+        super().__init__()
+        self.job_id = job_id
+        self.config = dict(config)
+        self.paths = list(paths)
+        self.control = control
+        self.methods = methods
+        self.profiler = job_profiler
+
+    def read_plates(self):
+        for idx, path in enumerate(self.paths):
+            if self.isInterruptionRequested():
+                return
+            yield load_image(path)
+            self.plate_evaluated.emit(self.job_id, idx)
+
+    def run(self):
+        with self.profiler.bind():
+            self.evaluate()
+
+    def evaluate(self):
+        try:
+            cube = evaluate_plates(self.config, self.read_plates(), self.control, self.methods)
+        except Exception as error:
+            self.series_failed.emit(self.job_id, str(error))
+            return
+        if not self.isInterruptionRequested():
+            self.series_finished.emit(self.job_id, cube)
+
+class WatchWorker(QThread):
+    # Scores the images written into a folder until interrupted, with the settings it was started with.
+    # Results files, summary.csv and watch_metrics.csv go to the results subfolder.
+    plate_watched = pyqtSignal(str, str, str)
+    watch_failed = pyqtSignal(str)
+
+    def __init__(self, config, folder, control_colors, workers, store=None):
+        super().__init__()
+        self.config = dict(config)
+        self.folder = folder
+        self.control_colors = control_colors
+        self.workers = workers
+        self.store = store
+
+    def run(self):
+        # A results path taken by a file, an unreadable control reference or a read-only folder would otherwise
+        # escape run() and abort the whole application
+        try:
+            evaluator = PlateEvaluator(self.config, self.control_colors, store=self.store)
+            output_dir = os.path.join(self.folder, "results")
+            os.makedirs(output_dir, exist_ok=True)
+            with ThreadPoolExecutor(self.workers) as executor:
+                watch = PlateWatch(FolderWatcher(self.folder), executor, partial(process_timed, evaluator), output_dir, self.config, 2*self.workers)
+                watch.on_plate = lambda path, results, error, metrics: self.plate_watched.emit(path, error or "", get_status_string(watch.get_status()))
+                watch.run(self.isInterruptionRequested)
+        except Exception as error:
+            self.watch_failed.emit(str(error))
+
 class CentralWidget(QWidget):
     def __init__(self, parent, width, config):
         super(QWidget, self).__init__(parent)
         self.layout = QVBoxLayout()
         self.tab_widget = QTabWidget()
-        samples_tab = TabSamples(width, config)
+        self.image_cache = ImageCache()
+        samples_tab = TabSamples(width, config, self.image_cache)
         parent.config_loaded_signal.connect(samples_tab.config_loaded_callback)
         self.tab_widget.addTab(samples_tab, "Samples")
-        control_tab = TabControl(width, config)
+        control_tab = TabControl(width, config, self.image_cache)
         parent.config_loaded_signal.connect(control_tab.config_loaded_callback)
         self.tab_widget.addTab(control_tab, "Control")
-        self.processing_tab = TabProcessing(config)
+        self.processing_tab = TabProcessing(config, self.image_cache)
         parent.config_loaded_signal.connect(self.processing_tab.config_loaded_callback)
+        control_tab.control_changed_signal.connect(self.processing_tab.control_changed_callback)
         self.tab_widget.addTab(self.processing_tab, "Processing")
         self.tab_widget.currentChanged.connect(self.current_changed)
         self.layout.addWidget(self.tab_widget)
@@ -105,9 +604,10 @@ class CentralWidget(QWidget):
             self.processing_tab.update_spacing_label()
 
 class TabSamples(QWidget):
-    def __init__(self, width, config):
+    def __init__(self, width, config, image_cache):
         super(QWidget, self).__init__()
         self.config = config
+        self.image_cache = image_cache
         self.layout = QVBoxLayout()
         self.target_spinboxes = []
 
@@ -127,13 +627,14 @@ class TabSamples(QWidget):
         # display image
         self.target_width = width
         self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.img_label = QLabel()
-        self.scroll_area.setWidget(self.img_label)
-        self.img_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.draw_crosses()
-        self.img_label.mousePressEvent = self.get_pixel
+        self.scroll_area.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.img_view = ImageView(self.scroll_area)
+        self.scroll_area.setWidget(self.img_view)
+        self.img_view.pixel_clicked.connect(self.get_pixel)
+        self.img_view.zoom_changed.connect(self.zoom_changed)
         self.img_details_label = QLabel()
+        self.image_id = None
+        self.draw_crosses()
         self.update_img_details()
         self.layout.addWidget(self.img_details_label)
         self.layout.addWidget(self.scroll_area,2)
@@ -214,19 +715,83 @@ class TabSamples(QWidget):
         self.calib_lower_corner_button.clicked.connect(self.on_lower_corner_button_clicked)
         self.calib_widget_set.append(self.calib_lower_corner_button)
         self.calib_layout.addWidget(self.calib_lower_corner_button, 1, 8)
+        # top right and bottom left corners, only used for a rotated grid
+        top_left, top_right, bottom_left, bottom_right = get_grid_corners(self.config)
+        self.calib_right_corner_label = QLabel("Top right corner:")
+        self.calib_right_corner_label.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.calib_right_corner_label.setFixedHeight(self.calib_upper_rows_label.sizeHint().height())
+        self.calib_layout.addWidget(self.calib_right_corner_label, 0, 9)
+        self.calib_right_corner_x = QSpinBox()
+        self.calib_right_corner_x.setMinimum(1)
+        self.calib_right_corner_x.setMaximum(10000)
+        self.calib_right_corner_x.setPrefix("x: ")
+        self.calib_right_corner_x.setValue(top_right[0])
+        self.calib_layout.addWidget(self.calib_right_corner_x, 0, 10)
+        self.calib_right_corner_y = QSpinBox()
+        self.calib_right_corner_y.setMinimum(1)
+        self.calib_right_corner_y.setMaximum(10000)
+        self.calib_right_corner_y.setPrefix("y: ")
+        self.calib_right_corner_y.setValue(top_right[1])
+        self.calib_layout.addWidget(self.calib_right_corner_y, 0, 11)
+        self.calib_right_corner_button = QPushButton("Select")
+        self.calib_right_corner_button.clicked.connect(self.on_right_corner_button_clicked)
+        self.calib_layout.addWidget(self.calib_right_corner_button, 0, 12)
+        self.calib_left_corner_label = QLabel("Bottom left corner:")
+        self.calib_left_corner_label.setAlignment(Qt.AlignmentFlag.AlignRight)
+        self.calib_left_corner_label.setFixedHeight(self.calib_lower_cols_label.sizeHint().height())
+        self.calib_layout.addWidget(self.calib_left_corner_label, 1, 9)
+        self.calib_left_corner_x = QSpinBox()
+        self.calib_left_corner_x.setMinimum(1)
+        self.calib_left_corner_x.setMaximum(10000)
+        self.calib_left_corner_x.setPrefix("x: ")
+        self.calib_left_corner_x.setValue(bottom_left[0])
+        self.calib_layout.addWidget(self.calib_left_corner_x, 1, 10)
+        self.calib_left_corner_y = QSpinBox()
+        self.calib_left_corner_y.setMinimum(1)
+        self.calib_left_corner_y.setMaximum(10000)
+        self.calib_left_corner_y.setPrefix("y: ")
+        self.calib_left_corner_y.setValue(bottom_left[1])
+        self.calib_layout.addWidget(self.calib_left_corner_y, 1, 11)
+        self.calib_left_corner_button = QPushButton("Select")
+        self.calib_left_corner_button.clicked.connect(self.on_left_corner_button_clicked)
+        self.calib_layout.addWidget(self.calib_left_corner_button, 1, 12)
+        self.calib_rotated_widget_set = [self.calib_right_corner_x, self.calib_right_corner_y, self.calib_right_corner_button, self.calib_left_corner_x, self.calib_left_corner_y, self.calib_left_corner_button]
+        self.calib_rotated_checkbox = QCheckBox("Rotated grid")
+        self.calib_rotated_checkbox.setChecked(GRID_CORNERS[0] in self.config)
+        self.calib_rotated_checkbox.toggled.connect(self.on_rotated_checkbox_toggled)
+        self.calib_widget_set.append(self.calib_rotated_checkbox)
+        self.calib_layout.addWidget(self.calib_rotated_checkbox, 0, 13, 2, 1)
+        # detect button
+        self.calib_detect_button = QPushButton("Detect grid")
+        self.calib_detect_button.clicked.connect(self.on_detect_button_clicked)
+        self.calib_widget_set.append(self.calib_detect_button)
+        self.calib_layout.addWidget(self.calib_detect_button, 0, 14, 2, 1)
         # apply button
         self.calib_upper_button = QPushButton("Apply")
         self.calib_upper_button.clicked.connect(self.on_apply_button_clicked)
         self.calib_widget_set.append(self.calib_upper_button)
-        self.calib_layout.addWidget(QLabel(), 0, 9)
-        self.calib_layout.addWidget(self.calib_upper_button, 0, 10, 2, 1)
+        self.calib_layout.addWidget(self.calib_upper_button, 0, 15, 2, 1)
         # cancel button
         self.calib_lower_button = QPushButton("Cancel")
         self.calib_lower_button.clicked.connect(self.on_cancel_button_clicked)
         self.calib_widget_set.append(self.calib_lower_button)
-        self.calib_layout.addWidget(self.calib_lower_button, 0, 11, 2, 1)
+        self.calib_layout.addWidget(self.calib_lower_button, 0, 16, 2, 1)
+        # live preview
+        self.methods = MicrotiterMethods()
+        self.live_checkbox = QCheckBox("Live preview")
+        self.live_checkbox.toggled.connect(self.on_live_checkbox_toggled)
+        self.calib_layout.addWidget(self.live_checkbox, 0, 17, 2, 1)
+        # Recomputing waits until the values stop changing for a moment
+        self.live_timer = QTimer(self)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.setInterval(150)
+        self.live_timer.timeout.connect(self.update_live_preview)
+        for spinbox in [self.calib_upper_rows_input, self.calib_lower_cols_input, self.calib_upper_corner_x, self.calib_upper_corner_y, self.calib_lower_corner_x, self.calib_lower_corner_y, self.calib_right_corner_x, self.calib_right_corner_y, self.calib_left_corner_x, self.calib_left_corner_y]:
+            spinbox.valueChanged.connect(self.schedule_live_preview)
+        self.calib_rotated_checkbox.toggled.connect(self.schedule_live_preview)
 
         self.widget_set_enabled(self.calib_widget_set, False)
+        self.widget_set_enabled(self.calib_rotated_widget_set, False)
 
         self.layout.addLayout(self.calib_layout)
 
@@ -235,15 +800,21 @@ class TabSamples(QWidget):
         self.setLayout(self.layout)
         
     def draw_crosses(self):
-        self.update_pixmap()
+        self.update_image()
         self.generate_grid()
-        for point in self.grid:
-            self.draw_one_cross(point[0], point[1])
-        self.img_label.setPixmap(self.pixmap)
-        self.img_label.update()
+        self.img_view.set_overlay(self.grid)
+
+    def update_image(self):
+        # The base image only changes with its file, calibration changes redraw just the overlay
+        path = self.config["path_samples"]
+        image_id = (path, self.image_cache.get_key(path))
+        if image_id != self.image_id:
+            self.image_id = image_id
+            self.update_pixmap()
                     
     def update_pixmap(self):
-        self.img = QImage(self.config["path_samples"])
+        path = self.config["path_samples"]
+        self.img = self.image_cache.get_image(path)
         if self.img.isNull():
             # self.img = QImage("image_not_found.jpg")
             temp_width = 1600
@@ -256,43 +827,28 @@ class TabSamples(QWidget):
             painter.setPen(QPen(QColor(0, 0, 0), 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
             painter.drawText(QPoint(round(temp_width/temp_scale/4), round(temp_height/temp_scale/2)), "Image not found")
             painter.end()
-        self.pixmap = QPixmap.fromImage(self.img)
-        self.pixmap = self.pixmap.scaledToWidth(self.target_width)
-        self.scale = self.img.width() / self.pixmap.width()
-        self.img_label.setPixmap(self.pixmap)
+            self.img_buffer = ImageBuffer(self.img)
+            pyramid = ImagePyramid(self.img, self.img.width())
+        else:
+            self.img_buffer = self.image_cache.get_buffer(path)
+            pyramid = self.image_cache.get_pyramid(path)
+        self.img_view.set_pyramid(pyramid, self.img_buffer.width, self.img_buffer.height, self.target_width)
+
+    def zoom_changed(self):
+        # Full resolution pixels per display pixel
+        self.scale = 1/self.img_view.zoom
+        self.update_img_details()
 
     def generate_grid(self):
-        grid = []
-        spacing_x = (self.config["bottom_right_x"]-self.config["top_left_x"])/(self.config["n_columns"] - 1)
-        spacing_y = (self.config["bottom_right_y"]-self.config["top_left_y"])/(self.config["n_rows"] - 1)
-        for i in range(self.config["n_rows"]):
-            for j in range(self.config["n_columns"]):
-                grid.append((round(self.config["top_left_x"]+j*spacing_x), round(self.config["top_left_y"]+i*spacing_y)))
-        self.grid = grid
+        self.grid = generate_grid(self.config)
     
-    def draw_one_cross(self, x, y):
-        x = round(x/self.scale)
-        y = round(y/self.scale)
-        cross_color = QColor(0, 255, 0)
-        painter = QPainter(self.pixmap)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing, False)
-        painter.setPen(QPen(cross_color, 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
-        cross_size = 10  # Fixed display pixels
-        painter.drawLine(x-cross_size, y, x+cross_size, y)
-        painter.drawLine(x, y-cross_size, x, y+cross_size)
-        painter.end()
-
     def update_img_details(self):
         if self.img.isNull():
             return
-        self.img_details_label.setText(f"Image Details | Width: {self.img.width()} | Height: {self.img.height()} | Scale: {round(1/self.scale, 2)}")
+        self.img_details_label.setText(f"Image Details | Width: {self.img_buffer.width} | Height: {self.img_buffer.height} | Scale: {round(1/self.scale, 2)}")
 
-    def get_pixel(self, event):
-        xoffset = (self.img_label.width() - self.pixmap.width()) / 2
-        yoffset = (self.img_label.height() - self.pixmap.height()) / 2
-        x = round(self.scale * (event.pos().x() - round(xoffset)))
-        y = round(self.scale * (event.pos().y() - round(yoffset)))
-        color = self.img.pixelColor(x, y)
+    def get_pixel(self, x, y):
+        color = QColor(*self.img_buffer.get_rgb(x, y))
         print(f"Pixel at ({x}, {y}) has color: {color.name()}")
         if self.target_spinboxes:
             self.target_spinboxes[0].setValue(x)
@@ -302,13 +858,66 @@ class TabSamples(QWidget):
             self.target_spinboxes = []
 
     def update_config(self):
-        self.config["path_samples"] = self.input_text.text()
-        self.config["top_left_x"] = self.calib_upper_corner_x.value()
-        self.config["top_left_y"] = self.calib_upper_corner_y.value()
-        self.config["bottom_right_x"] = self.calib_lower_corner_x.value()
-        self.config["bottom_right_y"] = self.calib_lower_corner_y.value()
-        self.config["n_columns"] = self.calib_lower_cols_input.value()
-        self.config["n_rows"] = self.calib_upper_rows_input.value()
+        for setting in GRID_CORNERS:
+            self.config.pop(setting, None)
+        self.config.update(self.get_calibration_config())
+
+    def get_calibration_config(self):
+        # Config with the values currently entered, applied or not
+        config = dict(self.config)
+        config["path_samples"] = self.input_text.text()
+        config["top_left_x"] = self.calib_upper_corner_x.value()
+        config["top_left_y"] = self.calib_upper_corner_y.value()
+        config["bottom_right_x"] = self.calib_lower_corner_x.value()
+        config["bottom_right_y"] = self.calib_lower_corner_y.value()
+        config["n_columns"] = self.calib_lower_cols_input.value()
+        config["n_rows"] = self.calib_upper_rows_input.value()
+        for setting in GRID_CORNERS:
+            config.pop(setting, None)
+        if self.calib_rotated_checkbox.isChecked():
+            config["top_right_x"] = self.calib_right_corner_x.value()
+            config["top_right_y"] = self.calib_right_corner_y.value()
+            config["bottom_left_x"] = self.calib_left_corner_x.value()
+            config["bottom_left_y"] = self.calib_left_corner_y.value()
+        return config
+
+    def schedule_live_preview(self):
+        if self.live_checkbox.isChecked():
+            self.live_timer.start()
+
+    def on_live_checkbox_toggled(self, checked):
+        if checked:
+            self.update_live_preview()
+        else:
+            self.live_timer.stop()
+            self.draw_crosses()
+
+    def update_live_preview(self):
+        config = self.get_calibration_config()
+        if config["n_rows"] < 2 or config["n_columns"] < 2:
+            return
+        try:
+            samples_image = self.image_cache.get_buffer(config["path_samples"])
+            control_image = self.image_cache.get_buffer(config["path_control"])
+            scores = evaluate_plate(config, samples_image.array, control_image.array, self.methods)
+        except Exception as error:
+            # Runs on every edit, so the error is shown in place of the preview rather than in a dialog
+            self.img_details_label.setText("Live preview failed: " + str(error))
+            self.draw_crosses()
+            return
+        self.update_img_details()
+        self.update_image()
+        self.grid = generate_grid(config)
+        self.draw_heatmap(config, scores)
+
+    def draw_heatmap(self, config, scores):
+        # Closest matches are green, farthest red, scaled between the plate minimum and maximum
+        span = scores.max() - scores.min()
+        levels = (scores - scores.min())/span if span else np.zeros_like(scores)
+        spacing_x, spacing_y = get_grid_spacing(config)
+        size = 0.8*min(spacing_x, spacing_y)
+        rects = [(x, y, size, QColor(round(255*level), round(255*(1-level)), 0, 110)) for (x, y), level in zip(self.grid, levels.ravel())]
+        self.img_view.set_overlay(self.grid, rects)
 
     def revert_to_config(self):
         self.input_text.setText(self.config["path_samples"])
@@ -318,6 +927,12 @@ class TabSamples(QWidget):
         self.calib_lower_corner_y.setValue(self.config["bottom_right_y"])
         self.calib_lower_cols_input.setValue(self.config["n_columns"])
         self.calib_upper_rows_input.setValue(self.config["n_rows"])
+        _, top_right, bottom_left, _ = get_grid_corners(self.config)
+        self.calib_right_corner_x.setValue(top_right[0])
+        self.calib_right_corner_y.setValue(top_right[1])
+        self.calib_left_corner_x.setValue(bottom_left[0])
+        self.calib_left_corner_y.setValue(bottom_left[1])
+        self.calib_rotated_checkbox.setChecked(GRID_CORNERS[0] in self.config)
 
     def on_input_button_clicked(self):
         file_name = QFileDialog.getOpenFileName(self, "Select Image of Samples", "", "Image files (*.*)")
@@ -326,6 +941,7 @@ class TabSamples(QWidget):
             self.input_text.setText(file_name[0])
             self.update_img_details()
             self.draw_crosses()
+            self.schedule_live_preview()
 
     def on_upper_corner_button_clicked(self):
         self.calib_upper_corner_x.setEnabled(False)
@@ -341,26 +957,71 @@ class TabSamples(QWidget):
         self.calib_upper_corner_y.setEnabled(True)
         self.target_spinboxes = [self.calib_lower_corner_x, self.calib_lower_corner_y]
 
+    def on_right_corner_button_clicked(self):
+        self.calib_right_corner_x.setEnabled(False)
+        self.calib_right_corner_y.setEnabled(False)
+        self.target_spinboxes = [self.calib_right_corner_x, self.calib_right_corner_y]
+
+    def on_left_corner_button_clicked(self):
+        self.calib_left_corner_x.setEnabled(False)
+        self.calib_left_corner_y.setEnabled(False)
+        self.target_spinboxes = [self.calib_left_corner_x, self.calib_left_corner_y]
+
+    def on_rotated_checkbox_toggled(self, checked):
+        # Without it the top right and bottom left corners follow from the other two
+        self.widget_set_enabled(self.calib_rotated_widget_set, checked and not self.calib_button.isEnabled())
+        if not checked:
+            self.calib_right_corner_x.setValue(self.calib_lower_corner_x.value())
+            self.calib_right_corner_y.setValue(self.calib_upper_corner_y.value())
+            self.calib_left_corner_x.setValue(self.calib_upper_corner_x.value())
+            self.calib_left_corner_y.setValue(self.calib_lower_corner_y.value())
+
+    def on_detect_button_clicked(self):
+        # Snaps the corner wells to the grid found in the image, rows and columns are kept as entered
+        config = self.get_calibration_config()
+        samples_image = self.image_cache.get_buffer(config["path_samples"])
+        try:
+            config = get_detected_config(config, samples_image.array)
+        except ValueError as error:
+            msg_box = MessageBox("Grid detection failed", str(error))
+            msg_box.exec()
+            return
+        self.calib_upper_corner_x.setValue(config["top_left_x"])
+        self.calib_upper_corner_y.setValue(config["top_left_y"])
+        self.calib_lower_corner_x.setValue(config["bottom_right_x"])
+        self.calib_lower_corner_y.setValue(config["bottom_right_y"])
+        self.calib_rotated_checkbox.setChecked(not is_axis_aligned(config))
+        self.calib_right_corner_x.setValue(config["top_right_x"])
+        self.calib_right_corner_y.setValue(config["top_right_y"])
+        self.calib_left_corner_x.setValue(config["bottom_left_x"])
+        self.calib_left_corner_y.setValue(config["bottom_left_y"])
+
     def on_calib_button_clicked(self):
         self.widget_set_enabled(self.calib_widget_set, True)
         self.calib_button.setEnabled(False)
+        self.widget_set_enabled(self.calib_rotated_widget_set, self.calib_rotated_checkbox.isChecked())
     
     def on_apply_button_clicked(self):
         self.update_config()
         self.widget_set_enabled(self.calib_widget_set, False)
+        self.widget_set_enabled(self.calib_rotated_widget_set, False)
         self.calib_button.setEnabled(True)
         self.draw_crosses()
+        self.schedule_live_preview()
 
     def on_cancel_button_clicked(self):
         self.revert_to_config()
         self.widget_set_enabled(self.calib_widget_set, False)
+        self.widget_set_enabled(self.calib_rotated_widget_set, False)
         self.calib_button.setEnabled(True)
 
     def config_loaded_callback(self):
         self.revert_to_config()
         self.widget_set_enabled(self.calib_widget_set, False)
+        self.widget_set_enabled(self.calib_rotated_widget_set, False)
         self.calib_button.setEnabled(True)
         self.draw_crosses()
+        self.schedule_live_preview()
 
     def widget_set_enabled(self, widgets, enabled):
         for widget in widgets:
@@ -370,9 +1031,11 @@ class TabSamples(QWidget):
                 pass
 
 class TabControl(QWidget):
-    def __init__(self, width, config):
+    control_changed_signal = pyqtSignal()
+    def __init__(self, width, config, image_cache):
         super(QWidget, self).__init__()
         self.config = config
+        self.image_cache = image_cache
         self.layout = QVBoxLayout()
 
         # input file
@@ -391,13 +1054,14 @@ class TabControl(QWidget):
         # display image
         self.target_width = width
         self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.img_label = QLabel()
-        self.scroll_area.setWidget(self.img_label)
-        self.img_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.draw_crosses()
-        self.img_label.mousePressEvent = self.get_pixel
+        self.scroll_area.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.img_view = ImageView(self.scroll_area)
+        self.scroll_area.setWidget(self.img_view)
+        self.img_view.pixel_clicked.connect(self.get_pixel)
+        self.img_view.zoom_changed.connect(self.zoom_changed)
         self.img_details_label = QLabel()
+        self.image_id = None
+        self.draw_crosses()
         self.update_img_details()
         self.layout.addWidget(self.img_details_label)
         self.layout.addWidget(self.scroll_area,2)
@@ -433,6 +1097,37 @@ class TabControl(QWidget):
 
         self.layout.addLayout(self.calib_layout)
 
+        # References, wells of the samples image or points of this image every well is also scored against
+        self.references_groupbox = QGroupBox("References")
+        self.references_layout = QVBoxLayout()
+        self.reference_fields_layout = QHBoxLayout()
+        self.reference_name = QLineEdit()
+        self.reference_name.setPlaceholderText("Name")
+        self.reference_fields_layout.addWidget(self.reference_name)
+        self.reference_value = QLineEdit()
+        self.reference_value.setPlaceholderText("Value on the standard curve (optional)")
+        self.reference_fields_layout.addWidget(self.reference_value)
+        self.reference_well = QLineEdit()
+        self.reference_well.setPlaceholderText("Well, e.g. A1")
+        self.reference_fields_layout.addWidget(self.reference_well)
+        self.add_well_reference_button = QPushButton("Add well")
+        self.add_well_reference_button.clicked.connect(self.on_add_well_reference_clicked)
+        self.reference_fields_layout.addWidget(self.add_well_reference_button)
+        self.add_control_reference_button = QPushButton("Add control center")
+        self.add_control_reference_button.clicked.connect(self.on_add_control_reference_clicked)
+        self.reference_fields_layout.addWidget(self.add_control_reference_button)
+        self.references_layout.addLayout(self.reference_fields_layout)
+        self.reference_list_layout = QHBoxLayout()
+        self.references_combobox = QComboBox()
+        self.reference_list_layout.addWidget(self.references_combobox, 2)
+        self.remove_reference_button = QPushButton("Remove")
+        self.remove_reference_button.clicked.connect(self.on_remove_reference_clicked)
+        self.reference_list_layout.addWidget(self.remove_reference_button)
+        self.references_layout.addLayout(self.reference_list_layout)
+        self.references_groupbox.setLayout(self.references_layout)
+        self.layout.addWidget(self.references_groupbox)
+        self.update_references_combobox()
+
         self.layout.addStretch()
 
         self.setLayout(self.layout)
@@ -440,16 +1135,25 @@ class TabControl(QWidget):
     def on_control_center_changed(self):
         self.update_config()
         self.draw_crosses()
+        self.control_changed_signal.emit()
         
     def draw_crosses(self):
-        self.update_pixmap()
+        self.update_image()
         # self.generate_grid()
-        self.draw_one_cross(self.config["control_x"], self.config["control_y"])
-        self.img_label.setPixmap(self.pixmap)
-        self.img_label.update()
+        references = self.config.get("references", [])
+        self.img_view.set_overlay([(self.config["control_x"], self.config["control_y"])] + [(reference["x"], reference["y"]) for reference in references if "well" not in reference])
+
+    def update_image(self):
+        # The base image only changes with its file, moving the control center redraws just the overlay
+        path = self.config["path_control"]
+        image_id = (path, self.image_cache.get_key(path))
+        if image_id != self.image_id:
+            self.image_id = image_id
+            self.update_pixmap()
                     
     def update_pixmap(self):
-        self.img = QImage(self.config["path_control"])
+        path = self.config["path_control"]
+        self.img = self.image_cache.get_image(path)
         if self.img.isNull():
             # self.img = QImage("image_not_found.jpg")
             temp_width = 1600
@@ -462,35 +1166,26 @@ class TabControl(QWidget):
             painter.setPen(QPen(QColor(0, 0, 0), 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
             painter.drawText(QPoint(round(temp_width/temp_scale/4), round(temp_height/temp_scale/2)), "Image not found")
             painter.end()
-        self.pixmap = QPixmap.fromImage(self.img)
-        self.pixmap = self.pixmap.scaledToWidth(self.target_width)
-        self.scale = self.img.width() / self.pixmap.width()
-        self.img_label.setPixmap(self.pixmap)
+            self.img_buffer = ImageBuffer(self.img)
+            pyramid = ImagePyramid(self.img, self.img.width())
+        else:
+            self.img_buffer = self.image_cache.get_buffer(path)
+            pyramid = self.image_cache.get_pyramid(path)
+        self.img_view.set_pyramid(pyramid, self.img_buffer.width, self.img_buffer.height, self.target_width)
 
-    
-    def draw_one_cross(self, x, y):
-        x = round(x/self.scale)
-        y = round(y/self.scale)
-        cross_color = QColor(0, 255, 0)
-        painter = QPainter(self.pixmap)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing, False)
-        painter.setPen(QPen(cross_color, 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
-        cross_size = 10  # Fixed display pixels
-        painter.drawLine(x-cross_size, y, x+cross_size, y)
-        painter.drawLine(x, y-cross_size, x, y+cross_size)
-        painter.end()
+    def zoom_changed(self):
+        # Full resolution pixels per display pixel
+        self.scale = 1/self.img_view.zoom
+        self.update_img_details()
 
+    
     def update_img_details(self):
         if self.img.isNull():
             return
-        self.img_details_label.setText(f"Image Details | Width: {self.img.width()} | Height: {self.img.height()} | Scale: {round(1/self.scale, 2)}")
+        self.img_details_label.setText(f"Image Details | Width: {self.img_buffer.width} | Height: {self.img_buffer.height} | Scale: {round(1/self.scale, 2)}")
 
-    def get_pixel(self, event):
-        xoffset = (self.img_label.width() - self.pixmap.width()) / 2
-        yoffset = (self.img_label.height() - self.pixmap.height()) / 2
-        x = round(self.scale * (event.pos().x() - round(xoffset)))
-        y = round(self.scale * (event.pos().y() - round(yoffset)))
-        color = self.img.pixelColor(x, y)
+    def get_pixel(self, x, y):
+        color = QColor(*self.img_buffer.get_rgb(x, y))
         print(f"Pixel at ({x}, {y}) has color: {color.name()}")
         if self.target_spinboxes:
             self.target_spinboxes[0].setValue(x)
@@ -508,6 +1203,72 @@ class TabControl(QWidget):
         self.input_text.setText(self.config["path_control"])
         self.calib_control_center_x.setValue(self.config["control_x"])
         self.calib_control_center_y.setValue(self.config["control_y"])
+        self.update_references_combobox()
+
+    def update_references_combobox(self):
+        self.references_combobox.clear()
+        for reference in self.config.get("references", []):
+            self.references_combobox.addItem(get_reference_label(reference))
+        self.remove_reference_button.setEnabled(self.references_combobox.count() > 0)
+
+    def get_new_reference(self, default_name):
+        # Name and optional value from the fields, None (after telling why) when the value is not a number
+        reference = {"name": self.reference_name.text().strip() or default_name}
+        value = self.reference_value.text().strip()
+        if value:
+            try:
+                reference["value"] = float(value)
+            except ValueError:
+                msg_box = MessageBox("Invalid reference", "The value " + repr(value) + " is not a number.")
+                msg_box.exec()
+                return None
+        return reference
+
+    def add_reference(self, reference):
+        self.config["references"] = self.config.get("references", []) + [reference]
+        self.reference_name.clear()
+        self.reference_value.clear()
+        self.references_changed()
+
+    def on_add_well_reference_clicked(self):
+        well = self.reference_well.text().strip().upper()
+        try:
+            parse_well(well, self.config["n_rows"], self.config["n_columns"])
+        except ValueError as error:
+            msg_box = MessageBox("Invalid reference", str(error))
+            msg_box.exec()
+            return
+        reference = self.get_new_reference(well)
+        if reference is not None:
+            reference["well"] = well
+            self.reference_well.clear()
+            self.add_reference(reference)
+
+    def on_add_control_reference_clicked(self):
+        x, y = self.config["control_x"], self.config["control_y"]
+        reference = self.get_new_reference("Control " + str(x) + ", " + str(y))
+        if reference is not None:
+            reference["x"] = x
+            reference["y"] = y
+            self.add_reference(reference)
+
+    def on_remove_reference_clicked(self):
+        references = list(self.config.get("references", []))
+        idx = self.references_combobox.currentIndex()
+        if not 0 <= idx < len(references):
+            return
+        del references[idx]
+        # Without references the config stays as it was before they existed
+        if references:
+            self.config["references"] = references
+        else:
+            self.config.pop("references", None)
+        self.references_changed()
+
+    def references_changed(self):
+        self.update_references_combobox()
+        self.draw_crosses()
+        self.control_changed_signal.emit()
 
     def on_input_button_clicked(self):
         file_name = QFileDialog.getOpenFileName(self, "Select Image of Control", "", "Image files (*.*)")
@@ -516,6 +1277,7 @@ class TabControl(QWidget):
             self.input_text.setText(file_name[0])
             self.update_img_details()
             self.draw_crosses()
+            self.control_changed_signal.emit()
 
     def on_control_center_button_clicked(self):
         self.calib_control_center_x.setEnabled(False)
@@ -527,11 +1289,21 @@ class TabControl(QWidget):
         self.draw_crosses()
 
 class TabProcessing(QWidget):
-    def __init__(self, config):
+    def __init__(self, config, image_cache):
         super(QWidget, self).__init__()
         self.config = config
+        self.image_cache = image_cache
         self.layout = QVBoxLayout()
         self.methods = MicrotiterMethods()
+        self.evaluation_job = 0
+        self.evaluation_worker = None
+        self.running_workers = set()
+        self.aggregation_cache = AggregationCache()
+        # Well colors of earlier sessions, the GUI works without them when the cache directory is not writable
+        try:
+            self.result_store = ResultStore()
+        except OSError:
+            self.result_store = None
 
         self.settings_layout = QHBoxLayout()
 
@@ -550,6 +1322,23 @@ class TabProcessing(QWidget):
         self.AoI_hbox.addWidget(self.AoI_label)
         self.AoI_layout.addLayout(self.AoI_hbox)
 
+        # Shape of the AoI, an annulus leaves out its inner disc and a mask image picks the pixels itself
+        self.AoI_shape_hbox = QHBoxLayout()
+        self.AoI_shape_combobox = QComboBox()
+        for code, label in AOI_SHAPES.items():
+            self.AoI_shape_combobox.addItem(label, code)
+        self.AoI_shape_combobox.activated.connect(self.AoI_shape_changed)
+        self.AoI_shape_hbox.addWidget(self.AoI_shape_combobox)
+        self.AoI_inner_spinbox = QSpinBox()
+        self.AoI_inner_spinbox.setPrefix("inner ")
+        self.AoI_inner_spinbox.editingFinished.connect(self.AoI_inner_updated)
+        self.AoI_shape_hbox.addWidget(self.AoI_inner_spinbox)
+        self.AoI_mask_button = QPushButton("Select mask")
+        self.AoI_mask_button.clicked.connect(self.AoI_mask_button_clicked)
+        self.AoI_shape_hbox.addWidget(self.AoI_mask_button)
+        self.AoI_layout.addLayout(self.AoI_shape_hbox)
+        self.update_AoI_shape_widgets()
+
         self.AoI_hint = QLabel()
         self.update_spacing_label()
         self.AoI_layout.addWidget(self.AoI_hint)
@@ -585,22 +1374,106 @@ class TabProcessing(QWidget):
         self.scoring_groupbox.setLayout(self.scoring_layout)
         self.settings_layout.addWidget(self.scoring_groupbox)
 
+        # Time series, several sample images sharing the grid and the control
+        self.series_paths = []
+        self.series_groupbox = QGroupBox("Time Series")
+        self.series_layout = QVBoxLayout()
+        self.series_button = QPushButton("Select images")
+        self.series_button.clicked.connect(self.series_button_clicked)
+        self.series_layout.addWidget(self.series_button)
+        self.series_label = QLabel("No images selected")
+        self.series_layout.addWidget(self.series_label)
+        self.series_interval = QDoubleSpinBox()
+        self.series_interval.setPrefix("Interval: ")
+        self.series_interval.setMaximum(100000)
+        self.series_interval.setValue(1)
+        self.series_layout.addWidget(self.series_interval)
+        self.series_threshold = QDoubleSpinBox()
+        self.series_threshold.setPrefix("Threshold: ")
+        self.series_threshold.setMaximum(100000)
+        self.series_threshold.setValue(50)
+        self.series_layout.addWidget(self.series_threshold)
+        self.series_groupbox.setLayout(self.series_layout)
+        self.settings_layout.addWidget(self.series_groupbox)
+
+        # Watch folder, scores the images a reader writes into a folder as they arrive
+        self.watch_folder = None
+        self.watch_worker = None
+        self.watch_groupbox = QGroupBox("Watch Folder")
+        self.watch_layout = QVBoxLayout()
+        self.watch_folder_button = QPushButton("Select folder")
+        self.watch_folder_button.clicked.connect(self.watch_folder_button_clicked)
+        self.watch_layout.addWidget(self.watch_folder_button)
+        self.watch_workers = QSpinBox()
+        self.watch_workers.setPrefix("Workers: ")
+        self.watch_workers.setRange(1, os.cpu_count() or 1)
+        self.watch_workers.setValue(max(1, (os.cpu_count() or 1)//2))
+        self.watch_layout.addWidget(self.watch_workers)
+        self.watch_button = QPushButton("Watch")
+        self.watch_button.setCheckable(True)
+        self.watch_button.setEnabled(False)
+        self.watch_button.toggled.connect(self.watch_toggled)
+        self.watch_layout.addWidget(self.watch_button)
+        self.watch_label = QLabel("No folder selected")
+        self.watch_label.setWordWrap(True)
+        self.watch_layout.addWidget(self.watch_label)
+        self.watch_groupbox.setLayout(self.watch_layout)
+        self.settings_layout.addWidget(self.watch_groupbox)
+
         self.layout.addLayout(self.settings_layout)
 
-        # Evaluate button
+        # Evaluate and cancel buttons
+        self.evaluate_layout = QHBoxLayout()
         self.evaluate_button = QPushButton("Evaluate")
         self.evaluate_button.clicked.connect(self.evaluate_clicked)
-        self.layout.addWidget(self.evaluate_button)
+        self.evaluate_layout.addWidget(self.evaluate_button, 2)
+        self.evaluate_series_button = QPushButton("Evaluate series")
+        self.evaluate_series_button.clicked.connect(self.evaluate_series_clicked)
+        self.evaluate_series_button.setEnabled(False)
+        self.evaluate_layout.addWidget(self.evaluate_series_button)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_clicked)
+        self.cancel_button.setEnabled(False)
+        self.evaluate_layout.addWidget(self.cancel_button)
+        self.layout.addLayout(self.evaluate_layout)
 
         # Results box
         self.results_box = QTextEdit()
         self.results_box.setReadOnly(True)
         self.layout.addWidget(self.results_box, 2)
 
-        # Save as CSV button
-        self.save_as_csv_button = QPushButton("Save as CSV")
-        self.save_as_csv_button.clicked.connect(self.save_as_csv_clicked)
-        self.layout.addWidget(self.save_as_csv_button)
+        # Profiling panel, collapsed and switched off until checked
+        self.profiling_groupbox = QGroupBox("Profiling")
+        self.profiling_groupbox.setCheckable(True)
+        self.profiling_groupbox.setChecked(False)
+        self.profiling_groupbox.toggled.connect(self.profiling_toggled)
+        self.profiling_layout = QVBoxLayout()
+        self.profiling_widget = QWidget()
+        self.profiling_widget_layout = QVBoxLayout()
+        self.profiling_widget_layout.setContentsMargins(0, 0, 0, 0)
+        self.profiling_label = QLabel("Evaluate to see the time spent in every stage.")
+        self.profiling_widget_layout.addWidget(self.profiling_label)
+        self.profiling_log_checkbox = QCheckBox("Append to profiling.log")
+        self.profiling_widget_layout.addWidget(self.profiling_log_checkbox)
+        self.profiling_widget.setLayout(self.profiling_widget_layout)
+        self.profiling_widget.setVisible(False)
+        self.profiling_layout.addWidget(self.profiling_widget)
+        self.profiling_groupbox.setLayout(self.profiling_layout)
+        self.layout.addWidget(self.profiling_groupbox)
+
+        # Export of the last results as a structured file, and the results box as it is
+        self.exported_plates = None
+        self.save_layout = QHBoxLayout()
+        self.export_button = QPushButton("Export results")
+        self.export_button.clicked.connect(self.export_clicked)
+        self.export_button.setEnabled(False)
+        self.save_layout.addWidget(self.export_button, 2)
+        self.export_append_checkbox = QCheckBox("Append to existing file")
+        self.save_layout.addWidget(self.export_append_checkbox)
+        self.save_as_text_button = QPushButton("Save as text")
+        self.save_as_text_button.clicked.connect(self.save_as_text_clicked)
+        self.save_layout.addWidget(self.save_as_text_button)
+        self.layout.addLayout(self.save_layout)
 
         self.update_spacing_label()
 
@@ -608,103 +1481,333 @@ class TabProcessing(QWidget):
         self.setLayout(self.layout)
 
     def evaluate_clicked(self):
-        samples_image = QImage(self.config["path_samples"])
-        control_image = QImage(self.config["path_control"])
-        # control_color = control_image.pixelColor(self.config["control_x"], self.config["control_y"])
-        results_array = []
-        spacing_x = (self.config["bottom_right_x"]-self.config["top_left_x"])/(self.config["n_columns"] - 1)
-        spacing_y = (self.config["bottom_right_y"]-self.config["top_left_y"])/(self.config["n_rows"] - 1)
-        aggregation_method_id = self.aggregation_button_group.checkedId()
-        scoring_method_id = self.scoring_button_group.checkedId()
-        # get control colors
-        control_r, control_g, control_b = self.aggregate_location(control_image, self.config["control_x"], self.config["control_y"], aggregation_method_id)
-        for i in range(self.config["n_rows"]):
-            row = []
-            for j in range(self.config["n_columns"]):
-                x = round(self.config["top_left_x"]+j*spacing_x)
-                y = round(self.config["top_left_y"]+i*spacing_y)
-                sample_r, sample_g, sample_b = self.aggregate_location(samples_image, x, y, aggregation_method_id)
-                score = self.methods.scoring_methods[scoring_method_id].calculate(sample_r, sample_g, sample_b, control_r, control_g, control_b)
-                row.append(score)
-            results_array.append(row)
-        res_string = self.get_results_string(results_array)
+        # A new evaluation supersedes the one still running
+        self.cancel_evaluation()
+        job_profiler = self.get_job_profiler()
+        if self.rescore(job_profiler):
+            return
+        with job_profiler.bind():
+            samples_image = self.image_cache.get_buffer(self.config["path_samples"])
+            control_image = self.image_cache.get_buffer(self.config["path_control"])
+        self.evaluation_job += 1
+        worker = EvaluationWorker(self.evaluation_job, self.config, samples_image.array, control_image.array, self.methods, job_profiler)
+        worker.aggregation_key = self.get_aggregation_key()
+        worker.stage_finished.connect(self.stage_finished)
+        worker.evaluation_finished.connect(self.evaluation_finished)
+        worker.evaluation_failed.connect(self.evaluation_failed)
+        # Keep a reference until the thread really stops, also after it was superseded
+        self.running_workers.add(worker)
+        worker.finished.connect(lambda: self.running_workers.discard(worker))
+        self.evaluation_worker = worker
+        self.results_box.setText("# Evaluating...")
+        self.cancel_button.setEnabled(True)
+        worker.start()
+
+    def series_button_clicked(self):
+        file_names = QFileDialog.getOpenFileNames(self, "Select Images of the Series", "", "Image files (*.*)")[0]
+        if file_names:
+            self.series_paths = sorted(file_names)
+            self.series_label.setText(str(len(self.series_paths)) + " images selected")
+            self.evaluate_series_button.setEnabled(True)
+
+    def evaluate_series_clicked(self):
+        self.cancel_evaluation()
+        job_profiler = self.get_job_profiler()
+        with job_profiler.bind():
+            control_image = self.image_cache.get_buffer(self.config["path_control"])
+        self.evaluation_job += 1
+        worker = SeriesEvaluationWorker(self.evaluation_job, self.config, self.series_paths, control_image.array, self.methods, job_profiler)
+        worker.plate_evaluated.connect(self.plate_evaluated)
+        worker.series_finished.connect(self.series_finished)
+        worker.series_failed.connect(self.series_failed)
+        self.running_workers.add(worker)
+        worker.finished.connect(lambda: self.running_workers.discard(worker))
+        self.evaluation_worker = worker
+        self.results_box.setText("# Evaluating series...")
+        self.cancel_button.setEnabled(True)
+        worker.start()
+
+    def watch_folder_button_clicked(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select Folder to Watch")
+        if folder:
+            self.watch_button.setChecked(False)
+            self.watch_folder = folder
+            self.watch_label.setText(folder)
+            self.watch_button.setEnabled(True)
+
+    def watch_toggled(self, checked):
+        if not checked:
+            self.stop_watching()
+            return
+        control_image = self.image_cache.get_buffer(self.config["path_control"])
+        try:
+            control_colors = aggregate_control(self.config, control_image.array, self.methods)
+        except Exception as error:
+            msg_box = MessageBox("Watching failed", str(error))
+            msg_box.exec()
+            self.watch_button.setChecked(False)
+            return
+        worker = WatchWorker(self.config, self.watch_folder, control_colors, self.watch_workers.value(), self.result_store)
+        worker.plate_watched.connect(self.plate_watched)
+        worker.watch_failed.connect(lambda message: self.watch_failed(worker, message))
+        self.running_workers.add(worker)
+        worker.finished.connect(lambda: self.running_workers.discard(worker))
+        self.watch_worker = worker
+        self.watch_folder_button.setEnabled(False)
+        self.watch_workers.setEnabled(False)
+        self.watch_label.setText("Watching " + self.watch_folder)
+        worker.start()
+
+    def stop_watching(self):
+        # Images already handed to the workers are still scored and recorded
+        if self.watch_worker is not None:
+            self.watch_worker.requestInterruption()
+            self.watch_worker = None
+        self.watch_folder_button.setEnabled(True)
+        self.watch_workers.setEnabled(True)
+
+    def watch_failed(self, worker, message):
+        if worker is not self.watch_worker:
+            return
+        msg_box = MessageBox("Watching failed", message)
+        msg_box.exec()
+        # Unchecking stops watching and frees the folder and worker settings again
+        self.watch_button.setChecked(False)
+
+    def plate_watched(self, path, error, status):
+        text = os.path.basename(path) + (": " + error if error else " scored") + "\n" + status
+        self.watch_label.setText(text)
+
+    def plate_evaluated(self, job_id, idx):
+        if job_id != self.evaluation_job:
+            return
+        self.results_box.append("# Image " + str(idx+1) + "/" + str(len(self.evaluation_worker.paths)) + " read")
+
+    def series_finished(self, job_id, cube):
+        if job_id != self.evaluation_job:
+            return
+        worker = self.evaluation_worker
+        self.evaluation_worker = None
+        self.cancel_button.setEnabled(False)
+        interval = self.series_interval.value()
+        threshold = self.series_threshold.value()
+        kinetics = get_kinetics(cube, np.arange(len(cube))*interval, threshold)
+        profiling_lines = self.get_profiling_lines(worker.profiler)
+        res_string = ""
+        for path, results_array in zip(worker.paths, cube):
+            res_string += self.get_results_string(results_array, dict(worker.config, path_samples=path), profiling_lines)
+        res_string += get_kinetics_string(kinetics, interval, threshold)
         self.results_box.setText(res_string)
-        print(res_string)
-
-    def aggregate_location(self, image, x, y, method_id):
-        aoi_r, aoi_g, aoi_b = self.get_AoI_rgb(image, x, y)
-        aggregated_r = self.methods.aggregation_methods[method_id].calculate(aoi_r)
-        aggregated_g = self.methods.aggregation_methods[method_id].calculate(aoi_g)
-        aggregated_b = self.methods.aggregation_methods[method_id].calculate(aoi_b)
-        return aggregated_r, aggregated_g, aggregated_b
-
-    def get_AoI_rgb(self, image, x, y):
-        aoi_r, aoi_g, aoi_b = [], [], []
-        half = self.config["AoI_size"]//2
-        for dy in range(-half, half+1):
-            row_r, row_g, row_b = [], [], []
-            for dx in range(-half, half+1):
-                pixel_r, pixel_g, pixel_b, _ = image.pixelColor(x+dx, y+dy).getRgb()
-                row_r.append(pixel_r)
-                row_g.append(pixel_g)
-                row_b.append(pixel_b)
-            aoi_r.append(row_r)
-            aoi_g.append(row_g)
-            aoi_b.append(row_b)
-        return np.array(aoi_r), np.array(aoi_g), np.array(aoi_b)
-    
-    def get_results_string(self, array):
-        nparray = np.array(array)
-        res = ""
-        # Embed settings as comments
-        res += "# Settings:\n"
-        res += "# path_samples = "+self.config["path_samples"]+"\n"
-        res += "# path_control = "+self.config["path_control"]+"\n"
-        res += "# top_left_x = "+str(self.config["top_left_x"])+"\n"
-        res += "# top_left_y = "+str(self.config["top_left_y"])+"\n"
-        res += "# bottom_right_x = "+str(self.config["bottom_right_x"])+"\n"
-        res += "# bottom_right_y = "+str(self.config["bottom_right_y"])+"\n"
-        res += "# n_rows = "+str(self.config["n_rows"])+"\n"
-        res += "# n_columns = "+str(self.config["n_columns"])+"\n"
-        res += "# control_x = "+str(self.config["control_x"])+"\n"
-        res += "# control_y = "+str(self.config["control_y"])+"\n"
-        res += "# AoI_size = "+str(self.config["AoI_size"])+"\n"
-        res += "# aggregation_method = "+self.methods.aggregation_methods[self.aggregation_button_group.checkedId()].label+"\n"
-        res += "# scoring_method = "+self.methods.scoring_methods[self.scoring_button_group.checkedId()].label+"\n"
-        # Simple min max positions
-        res += "# Results:\n"
-        idx_min = np.unravel_index(nparray.argmin(), nparray.shape)
-        res += "# Closest match: " + self.idx_to_letter(idx_min[0]) + str(idx_min[1]+1) + "\n"
-        idx_max = np.unravel_index(nparray.argmax(), nparray.shape)
-        res += "# Farthest match: " + self.idx_to_letter(idx_max[0]) + str(idx_max[1]+1) + "\n"
-
-        header = [str(i) for i in range(self.config["n_columns"]+1)]
-        for number in header:
-            res += str(number) + "\t"
-        res += "\n"
-        for idx, row in enumerate(array):
-            res += self.idx_to_letter(idx) + "\t"
-            for value in row:
-                res += str(round(value, 2)) + "\t"
-            res += "\n"
-        return res
-
-    def save_as_csv_clicked(self):
-        filename = QFileDialog.getSaveFileName(self, "Save as CSV", "", "CSV files (*.csv)")[0]
+        self.set_exported_plates([dict(worker.config, path_samples=path) for path in worker.paths], cube)
+        self.update_profiling(worker.config, worker.profiler)
+
+    def series_failed(self, job_id, message):
+        self.evaluation_failed(job_id, message)
+
+    def evaluation_failed(self, job_id, message):
+        if job_id != self.evaluation_job:
+            return
+        self.evaluation_worker = None
+        self.cancel_button.setEnabled(False)
+        self.results_box.append("# Evaluation failed: " + message)
+
+    def rescore(self, job_profiler=None):
+        # Reruns only the scoring stage when the well colors for the current settings are memoized or stored
+        samples_rgb = self.aggregation_cache.get(self.get_aggregation_key())
+        if samples_rgb is None and self.result_store is not None:
+            samples_rgb = self.result_store.get(self.result_store.get_key("wells", self.config))
+            if samples_rgb is not None:
+                samples_rgb = samples_rgb.reshape(self.config["n_rows"], self.config["n_columns"], 3)
+                self.aggregation_cache.put(self.get_aggregation_key(), samples_rgb)
+        if samples_rgb is None:
+            return False
+        job_profiler = job_profiler or self.get_job_profiler()
+        try:
+            with job_profiler.bind():
+                control_image = self.image_cache.get_buffer(self.config["path_control"])
+                control_colors = aggregate_control(self.config, control_image.array, self.methods)
+                results_array = score_colors(self.config, samples_rgb, control_colors, self.methods)
+        except Exception as error:
+            # Evaluating from scratch would fail the same way, so this is the result of the evaluation
+            msg_box = MessageBox("Evaluation failed", str(error))
+            msg_box.exec()
+            return True
+        self.show_results(results_array, self.config, samples_rgb, job_profiler)
+        return True
+
+    def get_aggregation_key(self):
+        return self.aggregation_cache.get_key(self.image_cache.get_key(self.config["path_samples"]), self.config)
+
+    def stage_finished(self, job_id, message):
+        if job_id != self.evaluation_job:
+            return
+        self.results_box.append("# " + message)
+
+    def evaluation_finished(self, job_id, results_array, samples_rgb):
+        if job_id != self.evaluation_job:
+            return
+        worker = self.evaluation_worker
+        self.aggregation_cache.put(worker.aggregation_key, samples_rgb)
+        if self.result_store is not None:
+            self.result_store.put(self.result_store.get_key("wells", worker.config), samples_rgb.reshape(-1, 3))
+        self.evaluation_worker = None
+        self.cancel_button.setEnabled(False)
+        self.show_results(results_array, worker.config, samples_rgb, worker.profiler)
+
+    def show_results(self, results_array, config, samples_rgb, job_profiler):
+        # The results hold the stages up to scoring, the profiling box the full report once every stage closed
+        profiling_lines = self.get_profiling_lines(job_profiler)
+        with job_profiler.bind():
+            with profiler.stage("results_string"):
+                res_string = self.get_results_string(results_array, config, profiling_lines)
+            if config.get("references") and samples_rgb is not None:
+                res_string += self.get_references_string(config, samples_rgb)
+        self.results_box.setText(res_string)
+        self.set_exported_plates([config], [results_array])
+        self.update_profiling(config, job_profiler)
+
+    def get_references_string(self, config, samples_rgb):
+        # Scored from the well colors of the evaluation, the control image is only read for references on it
+        control = self.image_cache.get_buffer(config["path_control"]).array if has_control_references(config) else None
+        try:
+            control_references = aggregate_control_references(config, control, self.methods)
+            return get_references_string(config, evaluate_references(config, samples_rgb, control_references, self.methods))
+        except ValueError as error:
+            return "# References failed: " + str(error) + "\n"
+
+    def profiling_toggled(self, checked):
+        profiler.enabled = checked
+        self.profiling_widget.setVisible(checked)
+
+    def get_job_profiler(self):
+        # Every job records into a profiler of its own, which superseded workers still running cannot touch
+        job_profiler = Profiler()
+        job_profiler.enabled = profiler.enabled
+        return job_profiler
+
+    def get_profiling_lines(self, job_profiler):
+        return job_profiler.get_report_lines() if job_profiler.enabled else None
+
+    def update_profiling(self, config, job_profiler):
+        if not job_profiler.enabled:
+            return
+        self.profiling_label.setText("\n".join(job_profiler.get_report_lines()))
+        if self.profiling_log_checkbox.isChecked():
+            job_profiler.write_log("profiling.log", config["path_samples"])
+
+    def cancel_clicked(self):
+        if self.cancel_evaluation():
+            self.results_box.append("# Evaluation cancelled")
+
+    def cancel_evaluation(self):
+        if self.evaluation_worker is None:
+            return False
+        self.evaluation_worker.requestInterruption()
+        self.evaluation_worker = None
+        # Results of the cancelled job still in the event queue are dropped by their old job id
+        self.evaluation_job += 1
+        self.cancel_button.setEnabled(False)
+        return True
+
+    def stop_evaluations(self):
+        self.cancel_evaluation()
+        self.stop_watching()
+        for worker in list(self.running_workers):
+            worker.wait()
+
+    def get_results_string(self, array, config, profiling_lines=None):
+        aggregation_label = self.methods.get_aggregation_method(config["aggregation_method"]).label
+        scoring_label = self.methods.get_scoring_method(config["scoring_method"]).label
+        return get_results_string(config, array, aggregation_label, scoring_label, profiling_lines)
+
+    def save_as_text_clicked(self):
+        filename = QFileDialog.getSaveFileName(self, "Save as Text", "", "Text files (*.txt)")[0]
         if filename:
-            if not filename.endswith(".csv"):
-                filename += ".csv"
+            if not filename.endswith(".txt"):
+                filename += ".txt"
             with open(filename, "w") as file:
                 file.write(self.results_box.toPlainText())
+
+    def set_exported_plates(self, configs, scores):
+        self.exported_plates = (configs, scores)
+        self.export_button.setEnabled(True)
+
+    def export_clicked(self):
+        formats = get_results_formats()
+        filters = [label + " (*" + extension + ")" for extension, label in formats.items()]
+        append = self.export_append_checkbox.isChecked()
+        options = QFileDialog.Option.DontConfirmOverwrite if append else QFileDialog.Option(0)
+        filename, selected_filter = QFileDialog.getSaveFileName(self, "Export Results", "", ";;".join(filters), options=options)
+        if not filename:
+            return
+        if os.path.splitext(filename)[1].lower() not in formats:
+            filename += list(formats)[filters.index(selected_filter)] if selected_filter in filters else ".csv"
+        configs, scores = self.exported_plates
+        try:
+            export_results(filename, configs, scores, append)
+        except (OSError, ValueError) as error:
+            msg_box = MessageBox("Export failed", str(error))
+            msg_box.exec()
     
     def idx_to_letter(self, idx):
-        return chr(ord('A')+idx)
+        return idx_to_letter(idx)
 
     def AoI_updated(self):
         value = self.sanitize_AoI(self.AoI_spinbox.value())
         self.AoI_spinbox.setValue(value)
+        if value != self.config["AoI_size"]:
+            self.cancel_evaluation()
+            self.methods.clear_weight_kernels()
         self.config["AoI_size"] = value
         self.AoI_label.setText("x "+str(value))
+        self.update_AoI_shape_widgets()
+
+    def AoI_shape_changed(self):
+        code = self.AoI_shape_combobox.currentData()
+        if code == "mask" and not self.select_AoI_mask():
+            self.update_AoI_shape_widgets()
+            return
+        if code != self.config.get("AoI_shape", "square"):
+            self.cancel_evaluation()
+        self.config["AoI_shape"] = code
+        self.update_AoI_shape_widgets()
+
+    def AoI_inner_updated(self):
+        value = self.AoI_inner_spinbox.value()
+        if value != self.config.get("AoI_inner_size", 0):
+            self.cancel_evaluation()
+        self.config["AoI_inner_size"] = value
+
+    def AoI_mask_button_clicked(self):
+        if self.select_AoI_mask():
+            self.config["AoI_shape"] = "mask"
+            self.update_AoI_shape_widgets()
+
+    def select_AoI_mask(self):
+        # The mask is only taken when it loads and has pixels, otherwise the AoI stays as it was
+        file_name = QFileDialog.getOpenFileName(self, "Select AoI Mask", "", "Image files (*.*)")[0]
+        if not file_name:
+            return False
+        try:
+            get_AoI_shape({"AoI_shape": "mask", "AoI_mask": file_name})
+        except (OSError, ValueError) as error:
+            msg_box = MessageBox("Invalid AoI mask", str(error))
+            msg_box.exec()
+            return False
+        self.cancel_evaluation()
+        self.config["AoI_mask"] = file_name
+        return True
+
+    def update_AoI_shape_widgets(self):
+        code = self.config.get("AoI_shape", "square")
+        self.AoI_shape_combobox.setCurrentIndex(self.AoI_shape_combobox.findData(code))
+        # The inner disc must leave a ring of at least one pixel
+        self.AoI_inner_spinbox.setMaximum(max(0, self.config["AoI_size"] - 1))
+        self.AoI_inner_spinbox.setValue(self.config.get("AoI_inner_size", 0))
+        if "AoI_inner_size" in self.config:
+            self.config["AoI_inner_size"] = self.AoI_inner_spinbox.value()
+        self.AoI_inner_spinbox.setEnabled(code == "annulus")
+        self.AoI_mask_button.setToolTip(self.config.get("AoI_mask", ""))
 
     def sanitize_AoI(self, num):
         if num % 2 == 1:
@@ -714,19 +1817,22 @@ class TabProcessing(QWidget):
     
     def aggregation_method_changed(self):
         id = self.aggregation_button_group.checkedId()
+        self.cancel_evaluation()
         self.config["aggregation_method"] = self.methods.aggregation_methods[id].code
 
     def scoring_method_changed(self):
         id = self.scoring_button_group.checkedId()
+        self.cancel_evaluation()
         self.config["scoring_method"] = self.methods.scoring_methods[id].code
+        self.rescore()
 
     def update_spacing_label(self):
-        spacing_x = (self.config["bottom_right_x"]-self.config["top_left_x"])/(self.config["n_columns"] - 1)
-        spacing_y = (self.config["bottom_right_y"]-self.config["top_left_y"])/(self.config["n_rows"] - 1)
+        spacing_x, spacing_y = get_grid_spacing(self.config)
         self.AoI_hint.setText("Current spacing: "+str(round(min(spacing_x, spacing_y)))+" pixels")
     
     def revert_to_config(self):
         self.AoI_spinbox.setValue(self.config["AoI_size"])
+        self.update_AoI_shape_widgets()
         self.update_spacing_label()
         for (idx, method) in enumerate(self.methods.aggregation_methods):
             if self.config["aggregation_method"] == method.code:
@@ -738,6 +1844,11 @@ class TabProcessing(QWidget):
     def config_loaded_callback(self):
         self.revert_to_config()
 
+    def control_changed_callback(self):
+        # Only live when the well colors are memoized, a running evaluation keeps its own control
+        if self.evaluation_worker is None:
+            self.rescore()
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow()
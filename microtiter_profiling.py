@@ -0,0 +1,82 @@
+import time
+import threading
+
+# Wall time and call count per pipeline stage, shared by the GUI, the analysis core and the methods.
+# Disabled by default; a disabled profiler hands out one shared no-op context, so instrumented code costs next to nothing.
+# Instrumented code records into the shared profiler below. A job binds its own profiler to the threads it runs on,
+# so jobs running at the same time (e.g. a superseded evaluation still finishing) each get a report of their own.
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        profiler = getattr(BOUND, "profiler", None) or self
+        if not profiler.enabled:
+            return NULL_STAGE
+        return ProfiledStage(profiler, name)
+
+    def bind(self):
+        # Context in which the stages of the current thread are recorded here
+        return BoundProfiler(self)
+
+    def record(self, name, seconds):
+        with self.lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def get_report_lines(self):
+        with self.lock:
+            stages = list(self.stages.items())
+        return [f"{name} = {round(total*1000, 3)} ms ({count} calls)" for name, (total, count) in stages]
+
+    def write_log(self, path, title):
+        with open(path, "a") as file:
+            file.write("# " + time.strftime("%Y-%m-%d %H:%M:%S") + " " + title + "\n")
+            for line in self.get_report_lines():
+                file.write(line + "\n")
+
+class ProfiledStage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+class BoundProfiler:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        self.previous = getattr(BOUND, "profiler", None)
+        BOUND.profiler = self.profiler
+        return self.profiler
+
+    def __exit__(self, *exc_info):
+        BOUND.profiler = self.previous
+        return False
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+BOUND = threading.local()
+
+profiler = Profiler()
@@ -0,0 +1,57 @@
+import os
+import sys
+import argparse
+import numpy as np
+
+# Uncompressed, memory-mapped frames for very large scans. A frame is a .npy file (a small header followed by
+# the raw (H, W, 3) uint8 pixels), so evaluation only pages in the rows the AoIs touch. A downsampled preview
+# for display is written once next to it.
+
+RAW_SUFFIX = ".npy"
+PREVIEW_SUFFIX = ".preview.png"
+PREVIEW_WIDTH = 2400
+
+def is_raw(path):
+    return path.lower().endswith(RAW_SUFFIX)
+
+def get_raw_path(path):
+    return os.path.splitext(path)[0] + RAW_SUFFIX
+
+def get_preview_path(raw_path):
+    return os.path.splitext(raw_path)[0] + PREVIEW_SUFFIX
+
+def open_raw(raw_path):
+    return np.load(raw_path, mmap_mode="r")
+
+def convert_to_raw(path, raw_path=None):
+    # Decodes the scan once and writes it as a frame plus its preview, returns the path of the frame
+    from microtiter_analysis import load_image
+    if raw_path is None:
+        raw_path = get_raw_path(path)
+    image = load_image(path)
+    frame = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.uint8, shape=image.shape)
+    frame[:] = image
+    frame.flush()
+    del frame
+    write_preview(raw_path)
+    return raw_path
+
+def write_preview(raw_path):
+    from skimage.io import imsave
+    frame = open_raw(raw_path)
+    # Striding only reads every step-th row of the frame
+    step = max(1, -(-frame.shape[1]//PREVIEW_WIDTH))
+    preview_path = get_preview_path(raw_path)
+    imsave(preview_path, np.ascontiguousarray(frame[::step, ::step]), check_contrast=False)
+    return preview_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="microtiter_raw", description="Convert large scans into memory-mapped frames for evaluation.")
+    parser.add_argument("images", nargs="+", help="scans to convert, each frame is written next to its image")
+    args = parser.parse_args(argv)
+    for path in args.images:
+        print(convert_to_raw(path))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
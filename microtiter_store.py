@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from microtiter_analysis import AGGREGATION_SETTINGS
+from microtiter_aoi import AOI_SHAPE_SETTINGS
+from microtiter_raw import is_raw
+
+# Results kept on disk between runs, content-addressed: every entry is keyed by the hash of the image bytes it
+# was computed from and the settings of its stage, so a stage is only recomputed when one of its inputs changed.
+# Stages: "grid" (detected corners), "wells" (aggregated colors), "control" (control color) and "scores".
+# Nothing in here may import PyQt6.
+
+# Part of every key, raise it when a change to the analysis makes stored results invalid
+STORE_VERSION = 3
+
+CORNER_SETTINGS = ("top_left_x", "top_left_y", "top_right_x", "top_right_y", "bottom_left_x", "bottom_left_y", "bottom_right_x", "bottom_right_y")
+CONTROL_SETTINGS = ("control_x", "control_y", "AoI_size") + AOI_SHAPE_SETTINGS + ("flat_field", "aggregation_method")
+
+def get_default_directory():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "microtiter_analyzer")
+
+class ResultStore:
+    # Entries are .npy files named <image hash>-<stage>-<key hash>, so all entries of an image can be found by name.
+    # Reading an entry touches it, and once the store holds more than max_bytes the least recently used go first.
+    def __init__(self, directory=None, max_bytes=512*1024*1024):
+        self.directory = directory or get_default_directory()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        # Image hashes by (path, size, mtime), so unchanged files are not read again
+        self.hashes = {}
+        # Evaluation workers and the GUI thread share the store
+        self.lock = threading.Lock()
+        self.size = sum(size for _, size, _ in self.list_entries())
+
+    def get_image_hash(self, path):
+        stat = os.stat(path)
+        file_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if file_key in self.hashes:
+                return self.hashes[file_key]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as file:
+            if is_raw(path):
+                # Raw frames can be gigabytes and are only paged in around the wells, reading all of them for the
+                # hash would undo that. They are identified by their header and first pixels, size and mtime instead,
+                # so touching a frame computes it again.
+                digest.update(file.read(1 << 16))
+                digest.update(f"{stat.st_size} {stat.st_mtime_ns}".encode())
+            else:
+                while chunk := file.read(1 << 20):
+                    digest.update(chunk)
+        with self.lock:
+            self.hashes[file_key] = digest.hexdigest()
+        return self.hashes[file_key]
+
+    def get_key(self, stage, config):
+        # (image hash, stage, key hash) of the stage for config, None when an input file cannot be read or is not set
+        try:
+            if stage == "control":
+                image_hash = self.get_image_hash(config["path_control"])
+            else:
+                image_hash = self.get_image_hash(config["path_samples"])
+            if stage == "grid":
+                settings = [config["n_rows"], config["n_columns"]]
+            elif stage == "wells":
+                settings = self.get_settings(config, AGGREGATION_SETTINGS)
+            elif stage == "control":
+                settings = self.get_settings(config, CONTROL_SETTINGS)
+            elif stage == "scores":
+                control_key = self.get_key("control", config)
+                if control_key is None:
+                    return None
+                settings = self.get_settings(config, AGGREGATION_SETTINGS) + [control_key, config["scoring_method"]]
+            else:
+                raise ValueError("Unknown stage: " + stage)
+        except (OSError, KeyError):
+            return None
+        text = json.dumps([STORE_VERSION, stage] + settings, default=str)
+        return (image_hash, stage, hashlib.blake2b(text.encode(), digest_size=16).hexdigest())
+
+    def get_settings(self, config, names):
+        settings = [config.get(name) for name in names]
+        # A mask and a gain map are identified by their content, not by their path
+        if config.get("AoI_shape") == "mask":
+            settings.append(self.get_image_hash(config["AoI_mask"]))
+        if config.get("flat_field"):
+            settings.append(self.get_image_hash(config["flat_field"]))
+        return settings
+
+    def get_path(self, key):
+        return os.path.join(self.directory, "-".join(key) + ".npy")
+
+    def get(self, key):
+        if key is None:
+            return None
+        path = self.get_path(key)
+        try:
+            array = np.load(path)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another process in the meantime
+            pass
+        return array
+
+    def put(self, key, array):
+        if key is None:
+            return
+        path = self.get_path(key)
+        # Written under another name first, so readers never see half an entry
+        temporary_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                np.save(file, np.asarray(array))
+            os.replace(temporary_path, path)
+        except OSError:
+            # A full or read-only disk only costs the entry, the result itself is fine
+            self.remove(temporary_path)
+            return
+        with self.lock:
+            self.size += os.path.getsize(path)
+            full = self.size > self.max_bytes
+        if full:
+            self.evict()
+
+    def list_entries(self):
+        # (path, size, last use) of every entry
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        # Removes the least recently used entries until the store is down to 90% of max_bytes
+        entries = sorted(self.list_entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if size <= 0.9*self.max_bytes:
+                break
+            self.remove(path)
+            size -= entry_size
+        with self.lock:
+            self.size = size
+
+    def invalidate(self, path):
+        # Forgets everything computed from the image at path, as samples and as control
+        image_hash = self.get_image_hash(path)
+        removed = 0
+        for entry_path, entry_size, _ in self.list_entries():
+            if os.path.basename(entry_path).startswith(image_hash + "-"):
+                self.remove(entry_path)
+                removed += 1
+                with self.lock:
+                    self.size -= entry_size
+        # Scores computed with this image as control are named after their samples. Their keys hold the control
+        # hash, so they are never read again and are left to eviction.
+        return removed
+
+    def clear(self):
+        for entry_path, _, _ in self.list_entries():
+            self.remove(entry_path)
+        with self.lock:
+            self.size = 0
+
+    def __getstate__(self):
+        # Sent to worker processes without the lock and the hashes, every process keeps its own
+        state = dict(self.__dict__)
+        del state["lock"], state["hashes"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
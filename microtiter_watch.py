@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from microtiter_analyzer import IMAGE_EXTENSIONS, PlateEvaluator, get_summary_header, get_summary_line, get_store, add_store_arguments
+from microtiter_export import get_results_writer_class, open_results_writer
+
+# Watch mode, scores the images a reader writes into a folder as they arrive, usage:
+# python -m microtiter_watch config.json /mnt/reader -j 4
+# New files are found by polling, which also works on network shares that do not report changes.
+# Nothing in here may import PyQt6, the GUI runs the same loop in a thread.
+
+METRICS_COLUMNS = ["image", "settle_s", "queue_s", "processing_s", "latency_s", "backlog", "running", "error"]
+
+class FolderWatcher:
+    # Hands out every new image of a folder once its size and modification time have not changed for
+    # settle_time seconds, so files that are still being written are never read half done
+    def __init__(self, directory, settle_time=2.0, include_existing=False):
+        self.directory = directory
+        self.settle_time = settle_time
+        # Path -> (size and mtime, first seen, unchanged since) of the files that are not done yet
+        self.writing = {}
+        self.seen = set()
+        if not include_existing:
+            self.seen.update(self.list_images())
+
+    def list_images(self):
+        names = sorted(os.listdir(self.directory))
+        return [os.path.join(self.directory, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    def poll(self):
+        # (path, first seen, ready) of the images that were completed since the last poll, in name order
+        now = time.time()
+        paths = self.list_images()
+        ready = []
+        for path in paths:
+            if path in self.seen:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            entry = self.writing.get(path)
+            if entry is None or entry[0] != signature:
+                self.writing[path] = (signature, now if entry is None else entry[1], now)
+            elif stat.st_size and now - entry[2] >= self.settle_time:
+                del self.writing[path]
+                self.seen.add(path)
+                ready.append((path, entry[1], now))
+        # Files removed or renamed before they were done
+        for path in set(self.writing).difference(paths):
+            del self.writing[path]
+        return ready
+
+class PlateWatch:
+    # Feeds the completed images of a FolderWatcher to an executor and appends their scores to a rolling summary.
+    # At most max_pending images are submitted at once, the others wait in the backlog: a backlog that keeps
+    # growing means more workers are needed, a queue wait near zero with an empty backlog means fewer would do.
+    def __init__(self, watcher, executor, process, output_dir, config, max_pending, poll_interval=1.0, on_plate=None):
+        self.watcher = watcher
+        self.executor = executor
+        # process(path, output_dir) returns (path, results, error, config, started, finished)
+        self.process = process
+        self.output_dir = output_dir
+        self.config = config
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.on_plate = on_plate
+        # Optional ResultsWriter every scored plate is added to
+        self.results_writer = None
+        self.summary_path = os.path.join(output_dir, "summary.csv")
+        self.metrics_path = os.path.join(output_dir, "watch_metrics.csv")
+        self.backlog = deque()
+        self.running = {}
+        self.last_poll = 0
+        self.scored = 0
+        self.failed = 0
+        # Metrics of the latest plates, for the status
+        self.recent = deque(maxlen=100)
+
+    def run(self, stop):
+        while not stop():
+            self.step()
+        # Plates already submitted are finished and recorded, the backlog is left for the next run
+        for future in list(self.running):
+            self.finish(future)
+
+    def step(self):
+        now = time.time()
+        if now - self.last_poll >= self.poll_interval:
+            self.last_poll = now
+            self.backlog.extend(self.watcher.poll())
+        while self.backlog and len(self.running) < self.max_pending:
+            path, detected, ready = self.backlog.popleft()
+            self.running[self.executor.submit(self.process, path, self.output_dir)] = (detected, ready)
+        if not self.running:
+            time.sleep(self.poll_interval)
+            return
+        done, _ = wait(self.running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            self.finish(future)
+
+    def finish(self, future):
+        detected, ready = self.running.pop(future)
+        path, results, error, config, started, finished = future.result()
+        metrics = {
+            "image": path,
+            "settle_s": ready - detected,
+            "queue_s": started - ready,
+            "processing_s": finished - started,
+            "latency_s": finished - detected,
+            "backlog": len(self.backlog),
+            "running": len(self.running),
+            # One line per plate, also for multi-line messages
+            "error": " ".join((error or "").split()),
+        }
+        self.recent.append(metrics)
+        if error is None:
+            self.scored += 1
+            append_line(self.summary_path, get_summary_header(self.config), get_summary_line(path, results))
+            if self.results_writer is not None:
+                self.results_writer.write(config, results)
+        else:
+            self.failed += 1
+        line = "\t".join(str(round(value, 3)) if isinstance(value, float) else str(value) for value in metrics.values())
+        append_line(self.metrics_path, "\t".join(METRICS_COLUMNS) + "\n", line + "\n")
+        if self.on_plate:
+            self.on_plate(path, results, error, metrics)
+
+    def get_status(self):
+        latencies = [metrics["latency_s"] for metrics in self.recent]
+        return {
+            "scored": self.scored,
+            "failed": self.failed,
+            "writing": len(self.watcher.writing),
+            "backlog": len(self.backlog),
+            "running": len(self.running),
+            "max_pending": self.max_pending,
+            "oldest_waiting_s": time.time() - self.backlog[0][2] if self.backlog else 0.0,
+            "latency_s": float(np.mean(latencies)) if latencies else 0.0,
+            "latency_p95_s": float(np.percentile(latencies, 95)) if latencies else 0.0,
+            "processing_s": float(np.mean([metrics["processing_s"] for metrics in self.recent])) if latencies else 0.0,
+        }
+
+def get_status_string(status):
+    res = f"scored {status['scored']}, failed {status['failed']}, writing {status['writing']}"
+    res += f", backlog {status['backlog']} (oldest {status['oldest_waiting_s']:.1f} s), running {status['running']}/{status['max_pending']}"
+    res += f", latency {status['latency_s']:.2f} s (p95 {status['latency_p95_s']:.2f} s), processing {status['processing_s']:.2f} s"
+    return res
+
+def append_line(path, header, line):
+    # Rolling output, the header is written when the file is started
+    with open(path, "a") as file:
+        if not file.tell():
+            file.write(header)
+        file.write(line)
+
+def process_timed(evaluator, path, output_dir):
+    started = time.time()
+    return evaluator.process(path, output_dir) + (started, time.time())
+
+worker_evaluator = None
+
+def init_worker(config, control_colors, detect_grid, store=None):
+    global worker_evaluator
+    worker_evaluator = PlateEvaluator(config, control_colors, detect_grid, store)
+
+def process_in_worker(path, output_dir):
+    return process_timed(worker_evaluator, path, output_dir)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="microtiter_watch", description="Score the plate images written into a folder as they arrive.")
+    parser.add_argument("config", help="config.json saved from the GUI")
+    parser.add_argument("folder", help="folder the reader writes the images into")
+    parser.add_argument("-o", "--output-dir", default="results", help="directory for the results files, summary.csv and watch_metrics.csv (default: results)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--queue-size", type=int, help="images submitted to the workers at once (default: twice the workers)")
+    parser.add_argument("--settle-time", type=float, default=2.0, help="seconds a file must stay unchanged before it is read (default: 2)")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between two looks at the folder (default: 1)")
+    parser.add_argument("--existing", action="store_true", help="also score the images already in the folder")
+    parser.add_argument("--detect-grid", action="store_true", help="detect the well grid in every image instead of using the corners from the config")
+    parser.add_argument("--export", help="also add the full precision results with their settings to a .csv, .npz or .parquet file, .npz and .parquet are completed when the watch stops")
+    add_store_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.config, "r") as file:
+        config = json.load(file)
+    if args.export:
+        try:
+            get_results_writer_class(args.export)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+    store = get_store(args)
+    try:
+        evaluator = PlateEvaluator(config, detect_grid=args.detect_grid, store=store)
+    except (OSError, ValueError) as error:
+        # Without the control (or the mask or gain map it is aggregated with) no plate can be scored
+        print(error, file=sys.stderr)
+        return 1
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(config, evaluator.control_colors, args.detect_grid, store))
+        process = process_in_worker
+    else:
+        executor = ThreadPoolExecutor(1)
+        process = partial(process_timed, evaluator)
+    watcher = FolderWatcher(args.folder, args.settle_time, args.existing)
+    def on_plate(path, results, error, metrics):
+        if error is not None:
+            print(f"{path}: {error}", file=sys.stderr)
+        print(f"{os.path.basename(path)}: {metrics['latency_s']:.2f} s, {get_status_string(watch.get_status())}", flush=True)
+    watch = PlateWatch(watcher, executor, process, args.output_dir, config, args.queue_size or 2*args.workers, args.poll_interval, on_plate)
+    if args.export:
+        watch.results_writer = open_results_writer(args.export, append=True)
+    print(f"Watching {args.folder} with {args.workers} workers, press Ctrl+C to stop", flush=True)
+    try:
+        watch.run(lambda: False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if watch.results_writer is not None:
+            watch.results_writer.close()
+    print(get_status_string(watch.get_status()))
+    return 1 if watch.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
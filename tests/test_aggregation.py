@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from microtiter_aoi import get_AoI_shape
+from microtiter_methods import MicrotiterMethods
+
+METHODS = MicrotiterMethods()
+
+def make_stack(pixels, values=256, seed=0):
+    # (wells, pixels, 3) AoI pixels, few distinct values make ties for the order statistics and the mode
+    return np.random.default_rng(seed).integers(0, values, (6, pixels, 3), dtype=np.uint8)
+
+def aggregate(code, stack):
+    return METHODS.get_aggregation_method(code).calculate_batch(stack, get_AoI_shape({"AoI_size": 1}))
+
+def trimmed_mean(values, fraction):
+    values = np.sort(values)
+    cut = int(len(values)*fraction)
+    return values[cut:len(values)-cut].mean()
+
+def mad_clipped_mean(values, clip_mads):
+    values = values.astype(float)
+    deviations = np.abs(values - np.median(values))
+    return values[deviations <= clip_mads*1.4826*np.median(deviations)].mean()
+
+def mode(values):
+    return np.bincount(values, minlength=256).argmax()
+
+def per_channel(function, stack):
+    return np.array([[function(stack[well, :, channel]) for channel in range(3)] for well in range(len(stack))])
+
+@pytest.mark.parametrize("pixels", [1, 2, 9, 25, 48])
+@pytest.mark.parametrize("values", [4, 256])
+def test_aggregation_matches_numpy(pixels, values):
+    stack = make_stack(pixels, values)
+    assert np.allclose(aggregate("arithmetic_mean", stack), stack.mean(axis=1))
+    assert np.allclose(aggregate("median", stack), np.median(stack, axis=1))
+    assert np.allclose(aggregate("percentile", stack), np.percentile(stack, METHODS.percentile, axis=1))
+    assert np.allclose(aggregate("trimmed_mean", stack), per_channel(lambda values: trimmed_mean(values, METHODS.trim_fraction), stack))
+    assert np.allclose(aggregate("mad_clipped_mean", stack), per_channel(lambda values: mad_clipped_mean(values, METHODS.clip_mads), stack))
+    assert np.array_equal(aggregate("mode", stack), per_channel(mode, stack))
+
+def test_weighted_mean_matches_per_well():
+    stack = make_stack(25)
+    shape = get_AoI_shape({"AoI_size": 5})
+    colors = METHODS.get_aggregation_method("weighted_mean").calculate_batch(stack, shape)
+    assert np.array_equal(colors, per_channel(lambda values: METHODS.weighted_mean(values.reshape(5, 5).astype(float)), stack))
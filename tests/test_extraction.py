@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from microtiter_aoi import get_AoI_shape
+from microtiter_analysis import get_AoI, get_AoI_pixels, get_AoI_pixels_rotated, ROTATED_AOI_CACHE
+
+def make_image(height=40, width=50, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+# Centers inside the image, on its edges and partly outside of it
+XS = np.array([25, 0, 49, 3, 46, 10, -2])
+YS = np.array([20, 0, 39, 36, 2, 30, 41])
+
+@pytest.mark.parametrize("size", [1, 2, 4, 5, 9])
+def test_batch_extraction_matches_per_well(size):
+    image = make_image()
+    shape = get_AoI_shape({"AoI_size": size})
+    stack = get_AoI_pixels(image, XS, YS, shape)
+    expected = np.stack([get_AoI(image, x, y, size).reshape(-1, 3) for x, y in zip(XS, YS)])
+    assert stack.dtype == np.uint8
+    assert np.array_equal(stack, expected)
+
+def test_batch_extraction_of_a_non_contiguous_image():
+    image = make_image()
+    shape = get_AoI_shape({"AoI_shape": "disc", "AoI_size": 7})
+    assert np.array_equal(get_AoI_pixels(np.asfortranarray(image), XS, YS, shape), get_AoI_pixels(image, XS, YS, shape))
+
+@pytest.mark.parametrize("config", [{"AoI_size": 1}, {"AoI_size": 5}, {"AoI_shape": "disc", "AoI_size": 9}, {"AoI_shape": "annulus", "AoI_size": 9, "AoI_inner_size": 4}])
+def test_rotated_extraction_without_rotation_matches_axis_aligned(config):
+    image = make_image()
+    shape = get_AoI_shape(config)
+    ROTATED_AOI_CACHE.clear()
+    for _ in range(2):
+        # Once computed and once from the cache
+        stack = get_AoI_pixels_rotated(image, XS.astype(float), YS.astype(float), shape, ((1.0, 0.0), (0.0, 1.0)))
+        assert np.array_equal(stack, get_AoI_pixels(image, XS, YS, shape))
+
+def test_rotated_extraction_turns_with_the_grid():
+    # Rows of the grid run down the image and its columns to the left, so the AoI is turned by 90 degrees
+    image = make_image()
+    shape = get_AoI_shape({"AoI_shape": "disc", "AoI_size": 7})
+    xs = np.array([25.0, 10.0])
+    ys = np.array([20.0, 30.0])
+    stack = get_AoI_pixels_rotated(image, xs, ys, shape, ((0.0, 1.0), (-1.0, 0.0)))
+    for well, (x, y) in enumerate(zip(xs.astype(int), ys.astype(int))):
+        assert np.array_equal(stack[well], image[y + shape.columns, x - shape.rows])
+
+def test_rotated_extraction_rounds_fractional_centers():
+    image = make_image()
+    shape = get_AoI_shape({"AoI_size": 3})
+    axes = ((1.0, 0.0), (0.0, 1.0))
+    stack = get_AoI_pixels_rotated(image, np.array([25.4, 25.6]), np.array([19.6, 20.4]), shape, axes)
+    assert np.array_equal(stack, get_AoI_pixels(image, np.array([25, 26]), np.array([20, 20]), shape))
+
+def test_rotated_extraction_cache_tells_grids_apart():
+    image = make_image()
+    shape = get_AoI_shape({"AoI_size": 5})
+    axes = ((1.0, 0.0), (0.0, 1.0))
+    ROTATED_AOI_CACHE.clear()
+    get_AoI_pixels_rotated(image, np.array([20.0]), np.array([20.0]), shape, axes)
+    stack = get_AoI_pixels_rotated(image, np.array([21.0]), np.array([20.0]), shape, axes)
+    assert np.array_equal(stack, get_AoI_pixels(image, np.array([21]), np.array([20]), shape))
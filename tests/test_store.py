@@ -0,0 +1,60 @@
+import os
+import numpy as np
+from microtiter_store import ResultStore
+
+def make_config(directory):
+    samples = os.path.join(directory, "samples.jpeg")
+    control = os.path.join(directory, "control.jpeg")
+    for path, content in ((samples, b"samples"), (control, b"control")):
+        with open(path, "wb") as file:
+            file.write(content)
+    return {"path_samples": samples, "path_control": control, "n_rows": 8, "n_columns": 12, "top_left_x": 10, "top_left_y": 10,
+        "bottom_right_x": 120, "bottom_right_y": 80, "control_x": 5, "control_y": 5, "AoI_size": 5,
+        "aggregation_method": "median", "scoring_method": "euclidian_rgb"}
+
+def test_keys_are_stable(tmp_path):
+    config = make_config(tmp_path)
+    store = ResultStore(os.path.join(tmp_path, "store"))
+    keys = [store.get_key(stage, config) for stage in ("grid", "wells", "control", "scores")]
+    assert None not in keys
+    assert len(set(keys)) == len(keys)
+    other_store = ResultStore(os.path.join(tmp_path, "store"))
+    assert [other_store.get_key(stage, dict(config)) for stage in ("grid", "wells", "control", "scores")] == keys
+
+def test_keys_follow_their_settings(tmp_path):
+    config = make_config(tmp_path)
+    store = ResultStore(os.path.join(tmp_path, "store"))
+    wells = store.get_key("wells", config)
+    scores = store.get_key("scores", config)
+    assert store.get_key("wells", dict(config, AoI_size=7)) != wells
+    assert store.get_key("wells", dict(config, top_right_x=125, top_right_y=12, bottom_left_x=8, bottom_left_y=80)) != wells
+    # Scoring and the control only matter from the scores on
+    assert store.get_key("wells", dict(config, scoring_method="euclidian_hsv")) == wells
+    assert store.get_key("wells", dict(config, control_x=6)) == wells
+    assert store.get_key("scores", dict(config, scoring_method="euclidian_hsv")) != scores
+    assert store.get_key("scores", dict(config, control_x=6)) != scores
+
+def test_keys_follow_the_image_content(tmp_path):
+    config = make_config(tmp_path)
+    store = ResultStore(os.path.join(tmp_path, "store"))
+    wells = store.get_key("wells", config)
+    control = store.get_key("control", config)
+    with open(config["path_samples"], "wb") as file:
+        file.write(b"other samples")
+    assert store.get_key("wells", config) != wells
+    assert store.get_key("control", config) == control
+
+def test_keys_of_missing_inputs(tmp_path):
+    config = make_config(tmp_path)
+    store = ResultStore(os.path.join(tmp_path, "store"))
+    assert store.get_key("wells", dict(config, path_samples=os.path.join(tmp_path, "missing.jpeg"))) is None
+    assert store.get_key("wells", dict(config, AoI_shape="mask")) is None
+
+def test_entries_round_trip(tmp_path):
+    config = make_config(tmp_path)
+    store = ResultStore(os.path.join(tmp_path, "store"))
+    key = store.get_key("wells", config)
+    colors = np.arange(8*12*3, dtype=float).reshape(8, 12, 3)
+    assert store.get(key) is None
+    store.put(key, colors)
+    assert np.array_equal(store.get(key), colors)